@@ -4,6 +4,17 @@ from primconsts import *
 from primasm import *
 
 class MemoryIf:
+    # page flags for ioPages(): one byte per 16 byte page
+    PAGE_SHIFT = 4
+    NUM_PAGES = 0x10000 >> PAGE_SHIFT
+    NO_IO = bytes(NUM_PAGES)
+    ALL_IO = bytes([1] * NUM_PAGES)
+    # (addr, kind, value) of watched accesses since the list was last
+    # cleared, see watch()
+    watchHits = ()
+    WATCH_READ = 1
+    WATCH_WRITE = 2
+
     def read8(self, addr):
         ...
     def read16(self, addr):
@@ -14,35 +25,143 @@ class MemoryIf:
         ...
     def reset(self):
         ...
+    def ram(self):
+        # bytearray backing the 64k address space for direct access by the
+        # CPU, None if every access has to go through read8/write8
+        return None
+    def ioPages(self):
+        # (read, write) page flags. Nonzero flags mark pages that have to be
+        # accessed through read8/write8 instead of ram().
+        return (MemoryIf.NO_IO, MemoryIf.NO_IO)
+    def watch(self, addr, size=1, kinds=WATCH_WRITE):
+        # Record accesses of the given kinds to [addr, addr+size) in
+        # watchHits, kinds 0 removes the watchpoint. Watched pages are
+        # flagged as I/O pages.
+        ...
+    def watching(self):
+        # True if a watchpoint is set
+        return False
+    def devicePages(self):
+        # write page flags of the pages with I/O devices. ioPages() may flag
+        # more pages (like pages to copy on write).
+        return self.ioPages()[1]
+    def isDevice(self, addr):
+        # True if a write to addr goes to an I/O device instead of RAM
+        return bool(self.devicePages()[(addr & 0xffff) >> MemoryIf.PAGE_SHIFT])
+    def snapshot(self):
+        # object for restore() holding the memory content, None if not
+        # supported
+        return None
+    def restore(self, snap):
+        ...
 
 class Prim:
-    # stack sizes
+    # default stack sizes, must be powers of 2
     DS_SIZE = 16
     RS_SIZE = 16
     # isr
     ISR_ADDR = 4
 
+    # reasons for run() to return
+    STOP_BREAK = 0
+    STOP_BREAKPOINT = 1
+    STOP_BUDGET = 2
+    STOP_WATCHPOINT = 3
+
+    NO_BREAKPOINTS = bytes(0x10000)
+
     LOG_LEVEL_MUTE = 0
     LOG_LEVEL_WARN = 1
     LOG_LEVEL_INF = 2
     LOG_LEVEL_DBG = 3
 
-    def __init__(self, mif, debug=None):
+    DISPATCH = None # opcode handler table, see buildDispatchTable()
+
+    def __init__(self, mif, debug=None, ds_size=DS_SIZE, rs_size=RS_SIZE):
+        assert ds_size > 0 and ds_size & (ds_size - 1) == 0, "Data stack size must be a power of 2"
+        assert rs_size > 0 and rs_size & (rs_size - 1) == 0, "Return stack size must be a power of 2"
         self._mif = mif # memory interface with read, write methodes
+        self._dsmask = ds_size - 1
+        self._rsmask = rs_size - 1
         self.reset()
-        self._log_level = Prim.LOG_LEVEL_MUTE
+        self._traceSink = None
+        self._journal = None
+        self._breakpoints = None
+        self.setLogLevel(Prim.LOG_LEVEL_MUTE)
+        self._stackChecks = False
         self._debug = debug
 
     def reset(self):
         self._pc = 0
-        self._ds = [0] * Prim.DS_SIZE
-        self._rs = [0] * Prim.RS_SIZE
+        self._ds = [0] * (self._dsmask + 1)
+        self._rs = [0] * (self._rsmask + 1)
         self._dsp = 0
         self._rsp = 0
         self._carry = 0
+        # stack depths and error counters, maintained with setStackChecks(True)
+        self._ddepth = 0
+        self._rdepth = 0
+        self.ds_overflows = 0
+        self.ds_underflows = 0
+        self.rs_overflows = 0
+        self.rs_underflows = 0
+
+    def snapshot(self):
+        # Registers, stacks and (if the memory interface supports it) memory.
+        # Translation caches (PrimJit, PrimDecoded) have to be invalidated
+        # after restore().
+        return (self._pc, list(self._ds), list(self._rs), self._dsp, self._rsp, self._carry,
+                self._ddepth, self._rdepth, self._mif.snapshot())
+
+    def restore(self, snap):
+        (self._pc, ds, rs, self._dsp, self._rsp, self._carry, self._ddepth, self._rdepth, mem) = snap
+        self._ds[:] = ds
+        self._rs[:] = rs
+        if mem is not None:
+            self._mif.restore(mem)
 
     def setLogLevel(self, level):
+        # selecting the execute path here keeps tracing out of muted runs
         self._log_level = level
+        self._traced = level >= Prim.LOG_LEVEL_DBG
+        self._stepwise = self._traced or self._journal is not None
+        self.execute = self.executeTraced if self._traced else self.executePlain
+
+    def setJournal(self, journal):
+        # journal.record() is called before every instruction executed by
+        # step(), run() then single steps. None switches recording off.
+        if journal is not None and self._journal is None:
+            self.step = self.stepJournaled
+        elif journal is None and self._journal is not None:
+            del self.step # back to the class method
+        self._journal = journal
+        self._stepwise = self._traced or journal is not None
+
+    def setStackChecks(self, enabled):
+        # Stacks wrap around silently. With checks enabled the stack depths
+        # are tracked and overflows/underflows are counted (and logged as
+        # warnings), at the cost of slower pushes and pops.
+        if enabled and not self._stackChecks:
+            (self.dpush, self.dpop) = (self.dpushChecked, self.dpopChecked)
+            (self.rpush, self.rpop) = (self.rpushChecked, self.rpopChecked)
+        elif self._stackChecks and not enabled:
+            # back to the class methods
+            del self.dpush, self.dpop, self.rpush, self.rpop
+        self._stackChecks = enabled
+
+    def setBreakpoints(self, breakpoints):
+        # Breakpoints object (see primbreak.py) checked by run(), None to
+        # remove. run() looks at an address only if its byte in
+        # breakpoints.flags is nonzero.
+        self._breakpoints = breakpoints
+
+    def setTraceSink(self, sink):
+        # sink(pc, opcode, T, N, R) is called before each instruction is
+        # executed with log level LOG_LEVEL_DBG. None restores printing.
+        self._traceSink = sink
+
+    def printTrace(self, pc, opcode, T, N, R):
+        self.log(Prim.LOG_LEVEL_DBG, f"execute {pc:04x}: {PrimAsm.disassembleOpcode(opcode)} (T: {T:x}, N: {N:x}, R: {R:x})")
 
     def log(self, level, s):
         sl = ["LOG_MUTE", "LOG_WARN", "LOG_INF", "LOG_DBG"]
@@ -73,30 +192,60 @@ class Prim:
         return w & 0xffff
 
     def dpush(self, value):
-        self._dsp = (self._dsp + 1) % Prim.DS_SIZE
+        self._dsp = (self._dsp + 1) & self._dsmask
         self._ds[self._dsp] = value & 0xffff
 
     def rpush(self, value):
-        self._rsp = (self._rsp + 1) % Prim.RS_SIZE
+        self._rsp = (self._rsp + 1) & self._rsmask
         self._rs[self._rsp] = value & 0xffff
 
     def dpop(self):
         dat = self._ds[self._dsp]
-        self._ds[self._dsp] = 0
-        self._dsp = (self._dsp - 1) % Prim.DS_SIZE
+        self._dsp = (self._dsp - 1) & self._dsmask
         return dat
 
     def rpop(self):
         dat = self._rs[self._rsp]
-        self._rs[self._rsp] = 0
-        self._rsp = (self._rsp - 1) % Prim.RS_SIZE
+        self._rsp = (self._rsp - 1) & self._rsmask
         return dat
 
+    def dpushChecked(self, value):
+        if self._ddepth > self._dsmask:
+            self.ds_overflows += 1
+            self.log(Prim.LOG_LEVEL_WARN, f"data stack overflow at {self._pc:04x}")
+        else:
+            self._ddepth += 1
+        Prim.dpush(self, value)
+
+    def rpushChecked(self, value):
+        if self._rdepth > self._rsmask:
+            self.rs_overflows += 1
+            self.log(Prim.LOG_LEVEL_WARN, f"return stack overflow at {self._pc:04x}")
+        else:
+            self._rdepth += 1
+        Prim.rpush(self, value)
+
+    def dpopChecked(self):
+        if self._ddepth == 0:
+            self.ds_underflows += 1
+            self.log(Prim.LOG_LEVEL_WARN, f"data stack underflow at {self._pc:04x}")
+        else:
+            self._ddepth -= 1
+        return Prim.dpop(self)
+
+    def rpopChecked(self):
+        if self._rdepth == 0:
+            self.rs_underflows += 1
+            self.log(Prim.LOG_LEVEL_WARN, f"return stack underflow at {self._pc:04x}")
+        else:
+            self._rdepth -= 1
+        return Prim.rpop(self)
+
     def T(self):
         return self._ds[self._dsp]
 
     def N(self):
-        return self._ds[(self._dsp - 1) % Prim.DS_SIZE]
+        return self._ds[(self._dsp - 1) & self._dsmask]
 
     def R(self):
         return self._rs[self._rsp]
@@ -107,128 +256,360 @@ class Prim:
             return value - (1<<bitwidth)
         return value
 
-    def execute(self, ir):
-        self.log(Prim.LOG_LEVEL_DBG, f"execute: {PrimAsm.disassembleOpcode(ir)}")
-        retbit = ir & 0x80
-        ir &= 0x7f
-        if ir == PrimOpcodes.NOP:
-            pass
-        elif ir == PrimOpcodes.CALL:
-            retbit = 0
-            self.rpush(self._pc)
-            addr = self.dpop()
-            self._pc = addr
-        elif ir == PrimOpcodes.JP:
-            retbit = 0
-            addr = self.dpop()
+    def opNop(self):
+        pass
+
+    def opCall(self):
+        self.rpush(self._pc)
+        self._pc = self.dpop()
+        return True
+
+    def opJp(self):
+        self._pc = self.dpop()
+        return True
+
+    def opJz(self):
+        (addr, f) = (self.dpop(), self.dpop())
+        if f == 0:
             self._pc = addr
-        elif ir == PrimOpcodes.JZ:
-            retbit = 0
-            (addr, f) = (self.dpop(), self.dpop())
-            if f == 0:
-                self._pc = addr
-        elif ir == PrimOpcodes.AND:
-            (T, N) = (self.dpop(), self.dpop())
-            self.dpush(N & T)
-        elif ir == PrimOpcodes.OR:
-            (T, N) = (self.dpop(), self.dpop())
-            self.dpush(N | T)
-        elif ir == PrimOpcodes.XOR:
-            (T, N) = (self.dpop(), self.dpop())
-            self.dpush(N ^ T)
-        elif ir == PrimOpcodes.NOT:
-            self.dpush(~self.dpop())
-        elif ir == PrimOpcodes.SR:
-            T = self.dpop()
-            self.dpush(T >> 1)
-            self._carry = (T & 1) != 0
-        elif ir == PrimOpcodes.SRW:
-            T = self.dpop()
-            self.dpush(T >> 8)
-            self._carry = (T & 1) != 0
-        elif ir == PrimOpcodes.SL:
-            T = self.dpop()
-            self.dpush(T << 1)
-            self._carry = (T & 0x10000) != 0
-        elif ir == PrimOpcodes.SLW:
-            T = self.dpop()
-            self.dpush(T << 8)
-            self._carry = (T & 0x10000) != 0
-        elif ir == PrimOpcodes.ADD:
-            (T, N) = (self.dpop(), self.dpop())
-            self.dpush(N + T)
-            self._carry = (N + T) > 0xffff
-        elif ir == PrimOpcodes.SUB:
-            (T, N) = (self.dpop(), self.dpop())
-            self.dpush(N - T)
-            self._carry = (N - T) < 0
-        elif ir == PrimOpcodes.LTS:
-            (T, N) = (self.dpop(), self.dpop())
-            res = Prim.comp2(N) < Prim.comp2(T)
-            self.dpush(0xffff if res else 0)
-        elif ir == PrimOpcodes.LTU:
-            (T, N) = (self.dpop(), self.dpop())
-            res = N < T
-            self.dpush(0xffff if res else 0)
-        elif ir == PrimOpcodes.SWAP:
-            (T, N) = (self.dpop(), self.dpop())
-            self.dpush(T)
-            self.dpush(N)
-        elif ir == PrimOpcodes.OVER:
-            self.dpush(self.N())
-        elif ir == PrimOpcodes.DUP:
-            self.dpush(self.T())
-        elif ir == PrimOpcodes.NIP:
-            T  = self.dpop()
-            self.dpop()
-            self.dpush(T)
-        elif ir == PrimOpcodes.ROT:
-            (T, N, n2) = (self.dpop(), self.dpop(), self.dpop())
-            self.dpush(N)
-            self.dpush(T)
-            self.dpush(n2)
-        elif ir == PrimOpcodes.NROT:
-            (T, N, n2) = (self.dpop(), self.dpop(), self.dpop())
-            self.dpush(T)
-            self.dpush(n2)
-            self.dpush(N)
-        elif ir == PrimOpcodes.DROP:
-            self.dpop()
-        elif ir == PrimOpcodes.RDROP:
-            self.rpop()
-        elif ir == PrimOpcodes.CARRY:
-            self.dpush(self._carry)
-        elif ir == PrimOpcodes.TO_R:
-            self.rpush(self.dpop())
-        elif ir == PrimOpcodes.FROM_R:
-            self.dpush(self.rpop())
-        elif ir == PrimOpcodes.INT:
-            retbit = 0
-            self.rpush(self._pc)
-            self._pc = Prim.ISR_ADDR
-        elif ir == PrimOpcodes.FETCH:
-            self.dpush(self.read16(self.dpop()))
-        elif ir == PrimOpcodes.BYTE_FETCH:
-            self.dpush(self.read8(self.dpop()) & 0xff)
-        elif ir == PrimOpcodes.STORE:
-            (addr, data) = (self.dpop(), self.dpop())
-            self._mif.write16(addr, data)
-        elif ir == PrimOpcodes.BYTE_STORE:
-            (addr, data) = (self.dpop(), self.dpop())
-            self.write8(addr, data)
-        elif ir == PrimOpcodes.PUSH8:
-            self.dpush(self.fetch8())
-        elif ir == PrimOpcodes.PUSH:
-            self.dpush(self.fetch16())
-        if retbit:
+        return True
+
+    def opAnd(self):
+        (T, N) = (self.dpop(), self.dpop())
+        self.dpush(N & T)
+
+    def opOr(self):
+        (T, N) = (self.dpop(), self.dpop())
+        self.dpush(N | T)
+
+    def opXor(self):
+        (T, N) = (self.dpop(), self.dpop())
+        self.dpush(N ^ T)
+
+    def opNot(self):
+        self.dpush(~self.dpop())
+
+    def opSr(self):
+        T = self.dpop()
+        self.dpush(T >> 1)
+        self._carry = (T & 1) != 0
+
+    def opSrw(self):
+        T = self.dpop()
+        self.dpush(T >> 8)
+        self._carry = (T & 1) != 0
+
+    def opSl(self):
+        T = self.dpop()
+        self.dpush(T << 1)
+        self._carry = (T & 0x10000) != 0
+
+    def opSlw(self):
+        T = self.dpop()
+        self.dpush(T << 8)
+        self._carry = (T & 0x10000) != 0
+
+    def opAdd(self):
+        (T, N) = (self.dpop(), self.dpop())
+        self.dpush(N + T)
+        self._carry = (N + T) > 0xffff
+
+    def opSub(self):
+        (T, N) = (self.dpop(), self.dpop())
+        self.dpush(N - T)
+        self._carry = (N - T) < 0
+
+    def opLts(self):
+        (T, N) = (self.dpop(), self.dpop())
+        res = Prim.comp2(N) < Prim.comp2(T)
+        self.dpush(0xffff if res else 0)
+
+    def opLtu(self):
+        (T, N) = (self.dpop(), self.dpop())
+        res = N < T
+        self.dpush(0xffff if res else 0)
+
+    def opSwap(self):
+        (T, N) = (self.dpop(), self.dpop())
+        self.dpush(T)
+        self.dpush(N)
+
+    def opOver(self):
+        self.dpush(self.N())
+
+    def opDup(self):
+        self.dpush(self.T())
+
+    def opNip(self):
+        T  = self.dpop()
+        self.dpop()
+        self.dpush(T)
+
+    def opRot(self):
+        (T, N, n2) = (self.dpop(), self.dpop(), self.dpop())
+        self.dpush(N)
+        self.dpush(T)
+        self.dpush(n2)
+
+    def opNrot(self):
+        (T, N, n2) = (self.dpop(), self.dpop(), self.dpop())
+        self.dpush(T)
+        self.dpush(n2)
+        self.dpush(N)
+
+    def opDrop(self):
+        self.dpop()
+
+    def opRdrop(self):
+        self.rpop()
+
+    def opCarry(self):
+        self.dpush(self._carry)
+
+    def opToR(self):
+        self.rpush(self.dpop())
+
+    def opFromR(self):
+        self.dpush(self.rpop())
+
+    def opInt(self):
+        self.rpush(self._pc)
+        self._pc = Prim.ISR_ADDR
+        return True
+
+    def opFetch(self):
+        self.dpush(self.read16(self.dpop()))
+
+    def opByteFetch(self):
+        self.dpush(self.read8(self.dpop()) & 0xff)
+
+    def opStore(self):
+        (addr, data) = (self.dpop(), self.dpop())
+        self._mif.write16(addr, data)
+
+    def opByteStore(self):
+        (addr, data) = (self.dpop(), self.dpop())
+        self.write8(addr, data)
+
+    def opPush8(self):
+        self.dpush(self.fetch8())
+
+    def opPush(self):
+        self.dpush(self.fetch16())
+
+    def buildDispatchTable():
+        # one handler per 7-bit opcode, unused opcodes behave like NOP.
+        # Handlers of control flow instructions return True, which
+        # suppresses the return bit.
+        table = [Prim.opNop] * 128
+        table[PrimOpcodes.CALL] = Prim.opCall
+        table[PrimOpcodes.JP] = Prim.opJp
+        table[PrimOpcodes.JZ] = Prim.opJz
+        table[PrimOpcodes.AND] = Prim.opAnd
+        table[PrimOpcodes.OR] = Prim.opOr
+        table[PrimOpcodes.XOR] = Prim.opXor
+        table[PrimOpcodes.NOT] = Prim.opNot
+        table[PrimOpcodes.SR] = Prim.opSr
+        table[PrimOpcodes.SRW] = Prim.opSrw
+        table[PrimOpcodes.SL] = Prim.opSl
+        table[PrimOpcodes.SLW] = Prim.opSlw
+        table[PrimOpcodes.ADD] = Prim.opAdd
+        table[PrimOpcodes.SUB] = Prim.opSub
+        table[PrimOpcodes.LTS] = Prim.opLts
+        table[PrimOpcodes.LTU] = Prim.opLtu
+        table[PrimOpcodes.SWAP] = Prim.opSwap
+        table[PrimOpcodes.OVER] = Prim.opOver
+        table[PrimOpcodes.DUP] = Prim.opDup
+        table[PrimOpcodes.NIP] = Prim.opNip
+        table[PrimOpcodes.ROT] = Prim.opRot
+        table[PrimOpcodes.NROT] = Prim.opNrot
+        table[PrimOpcodes.DROP] = Prim.opDrop
+        table[PrimOpcodes.RDROP] = Prim.opRdrop
+        table[PrimOpcodes.CARRY] = Prim.opCarry
+        table[PrimOpcodes.TO_R] = Prim.opToR
+        table[PrimOpcodes.FROM_R] = Prim.opFromR
+        table[PrimOpcodes.INT] = Prim.opInt
+        table[PrimOpcodes.FETCH] = Prim.opFetch
+        table[PrimOpcodes.BYTE_FETCH] = Prim.opByteFetch
+        table[PrimOpcodes.STORE] = Prim.opStore
+        table[PrimOpcodes.BYTE_STORE] = Prim.opByteStore
+        table[PrimOpcodes.PUSH8] = Prim.opPush8
+        table[PrimOpcodes.PUSH] = Prim.opPush
+        return table
+
+    def executePlain(self, ir):
+        if not Prim.DISPATCH[ir & 0x7f](self) and (ir & 0x80):
             self._pc = self.rpop()
 
+    def executeTraced(self, ir):
+        # the opcode has already been fetched, so it was located at pc-1
+        sink = self._traceSink or self.printTrace
+        sink((self._pc - 1) & 0xffff, ir, self.T(), self.N(), self.R())
+        self.executePlain(ir)
+
     def step(self):
         ir = self.fetch8()
         if ir != PrimOpcodes.BREAK:
             self.execute(ir)
         return ir & 0x7f
 
+    def stepJournaled(self):
+        self._journal.record()
+        return Prim.step(self)
+
+    def run(self, max_steps, stop_at=()):
+        # Execute up to max_steps instructions. Stops after a BREAK, when
+        # the pc reaches an address in stop_at or a breakpoint, or after an
+        # instruction that hit a watchpoint. Returns (reason, steps).
+        # Registers are kept in locals, the program counter is written back
+        # before handlers are called. Memory is accessed directly in the RAM
+        # bytearray, except for pages the memory interface flags as I/O.
+        if self._stepwise:
+            return self.runStepwise(max_steps, stop_at)
+        dispatch = Prim.DISPATCH
+        mif = self._mif
+        mem = mif.ram()
+        if mem is None:
+            (rio, wio) = (MemoryIf.ALL_IO, MemoryIf.ALL_IO)
+        else:
+            (rio, wio) = mif.ioPages()
+        shift = MemoryIf.PAGE_SHIFT
+        (read8, read16, write8, write16) = (mif.read8, mif.read16, mif.write8, mif.write16)
+        # accesses through the memory interface may hit a watchpoint, the
+        # loop then ends after the instruction
+        watch_hits = mif.watchHits
+        breakpoints = self._breakpoints
+        bflags = breakpoints.flags if breakpoints is not None else Prim.NO_BREAKPOINTS
+        dpush = self.dpush
+        dpop = self.dpop
+        rpush = self.rpush
+        rpop = self.rpop
+        (PUSH8, PUSH, CALL, JP, JZ, BREAK) = (PrimOpcodes.PUSH8, PrimOpcodes.PUSH,
+            PrimOpcodes.CALL, PrimOpcodes.JP, PrimOpcodes.JZ, PrimOpcodes.BREAK)
+        (FETCH, STORE, BYTE_FETCH, BYTE_STORE) = (PrimOpcodes.FETCH, PrimOpcodes.STORE,
+            PrimOpcodes.BYTE_FETCH, PrimOpcodes.BYTE_STORE)
+        pc = self._pc
+        steps = 0
+        reason = Prim.STOP_BUDGET
+        while steps < max_steps:
+            if rio[pc >> shift]:
+                ir = read8(pc)
+                if watch_hits:
+                    max_steps = 0
+            else:
+                ir = mem[pc]
+            pc = (pc + 1) & 0xffff
+            steps += 1
+            op = ir & 0x7f
+            if op == PUSH8:
+                if rio[pc >> shift]:
+                    dpush(read8(pc))
+                    if watch_hits:
+                        max_steps = 0
+                else:
+                    dpush(mem[pc])
+                pc = (pc + 1) & 0xffff
+                if ir & 0x80:
+                    pc = rpop()
+            elif op == PUSH:
+                a1 = (pc + 1) & 0xffff
+                if rio[pc >> shift] or rio[a1 >> shift]:
+                    dpush(read16(pc))
+                    if watch_hits:
+                        max_steps = 0
+                else:
+                    dpush(mem[pc] | (mem[a1] << 8))
+                pc = (pc + 2) & 0xffff
+                if ir & 0x80:
+                    pc = rpop()
+            elif op == CALL:
+                rpush(pc)
+                pc = dpop()
+            elif op == JP:
+                pc = dpop()
+            elif op == JZ:
+                (addr, f) = (dpop(), dpop())
+                if f == 0:
+                    pc = addr
+            elif op == FETCH:
+                addr = dpop()
+                a1 = (addr + 1) & 0xffff
+                if rio[addr >> shift] or rio[a1 >> shift]:
+                    dpush(read16(addr))
+                    if watch_hits:
+                        max_steps = 0
+                else:
+                    dpush(mem[addr] | (mem[a1] << 8))
+                if ir & 0x80:
+                    pc = rpop()
+            elif op == STORE:
+                (addr, data) = (dpop(), dpop())
+                a1 = (addr + 1) & 0xffff
+                if wio[addr >> shift] or wio[a1 >> shift]:
+                    write16(addr, data)
+                    if watch_hits:
+                        max_steps = 0
+                else:
+                    mem[addr] = data & 0xff
+                    mem[a1] = data >> 8
+                if ir & 0x80:
+                    pc = rpop()
+            elif op == BYTE_FETCH:
+                addr = dpop()
+                if rio[addr >> shift]:
+                    dpush(read8(addr) & 0xff)
+                    if watch_hits:
+                        max_steps = 0
+                else:
+                    dpush(mem[addr])
+                if ir & 0x80:
+                    pc = rpop()
+            elif op == BYTE_STORE:
+                (addr, data) = (dpop(), dpop())
+                if wio[addr >> shift]:
+                    write8(addr, data)
+                    if watch_hits:
+                        max_steps = 0
+                else:
+                    mem[addr] = data & 0xff
+                if ir & 0x80:
+                    pc = rpop()
+            elif op == BREAK:
+                if ir & 0x80:
+                    pc = rpop()
+                reason = Prim.STOP_BREAK
+                break
+            else:
+                self._pc = pc
+                if dispatch[op](self):
+                    pc = self._pc
+                elif ir & 0x80:
+                    pc = rpop()
+            if pc in stop_at or (bflags[pc] and breakpoints.hit(self, pc)):
+                reason = Prim.STOP_BREAKPOINT
+                break
+        if reason == Prim.STOP_BUDGET and watch_hits:
+            reason = Prim.STOP_WATCHPOINT
+        self._pc = pc
+        return (reason, steps)
+
+    def runStepwise(self, max_steps, stop_at=()):
+        # same as run(), but every instruction goes through step()
+        breakpoints = self._breakpoints
+        bflags = breakpoints.flags if breakpoints is not None else Prim.NO_BREAKPOINTS
+        watch_hits = self._mif.watchHits
+        steps = 0
+        while steps < max_steps:
+            steps += 1
+            if self.step() == PrimOpcodes.BREAK:
+                return (Prim.STOP_BREAK, steps)
+            pc = self._pc
+            if pc in stop_at or (bflags[pc] and breakpoints.hit(self, pc)):
+                return (Prim.STOP_BREAKPOINT, steps)
+            if watch_hits:
+                return (Prim.STOP_WATCHPOINT, steps)
+        return (Prim.STOP_BUDGET, steps)
+
     def status(self):
         print(f"pc: {self._pc:04x}")
         sys.stdout.write("ds: ")
@@ -239,3 +620,6 @@ class Prim:
         for r in range(self._rsp+1):
             sys.stdout.write(f"{self._rs[r]:x} ")
         print()
+
+
+Prim.DISPATCH = Prim.buildDispatchTable()
@@ -0,0 +1,351 @@
+#! /usr/bin/env python3
+
+import argparse
+import sys
+import time
+import numpy as np
+
+from prim import Prim
+from primconsts import *
+from primmem import Memory
+
+class PrimBatch:
+    # N Prim CPUs advanced in lock step with NumPy.
+    # Registers, stacks and memories of all lanes are held in arrays, step()
+    # executes one instruction on every lane that has not yet run into a
+    # BREAK. Lanes are grouped by opcode and each group is executed by a
+    # vectorized handler with the semantics of the Prim handler of the same
+    # name (see checkAgainstPrim()). There is no memory mapped I/O.
+    # Each lane has its own 64k of memory, with shared_memory all lanes run
+    # on one read-only memory, which is cheaper for many lanes.
+    DISPATCH = None # opcode handler table, see buildDispatchTable()
+
+    def __init__(self, n, image=None, shared_memory=False, ds_size=Prim.DS_SIZE, rs_size=Prim.RS_SIZE):
+        assert ds_size > 0 and ds_size & (ds_size - 1) == 0, "Data stack size must be a power of 2"
+        assert rs_size > 0 and rs_size & (rs_size - 1) == 0, "Return stack size must be a power of 2"
+        self.n = n
+        self.pc = np.zeros(n, np.int64)
+        self.ds = np.zeros((n, ds_size), np.int64)
+        self.rs = np.zeros((n, rs_size), np.int64)
+        self.dsp = np.zeros(n, np.int64)
+        self.rsp = np.zeros(n, np.int64)
+        self.carry = np.zeros(n, bool)
+        self.halted = np.zeros(n, bool) # lane executed a BREAK
+        self.steps = np.zeros(n, np.int64) # executed instructions per lane
+        self.shared_memory = shared_memory
+        self.mem = np.zeros((1 if shared_memory else n, 0x10000), np.uint8)
+        self._dmask = ds_size - 1
+        self._rmask = rs_size - 1
+        if image is not None:
+            image = np.frombuffer(bytes(image), np.uint8)
+            self.mem[:, 0:len(image)] = image
+
+    def rows(self, lanes):
+        # memory rows of lanes
+        return np.zeros_like(lanes) if self.shared_memory else lanes
+
+    def read8(self, lanes, addr):
+        return self.mem[self.rows(lanes), addr & 0xffff].astype(np.int64)
+
+    def read16(self, lanes, addr):
+        return self.read8(lanes, addr) | (self.read8(lanes, addr + 1) << 8)
+
+    def write8(self, lanes, addr, value):
+        if self.shared_memory and len(lanes):
+            raise ValueError("Store into shared memory")
+        self.mem[lanes, addr & 0xffff] = value & 0xff
+
+    def write16(self, lanes, addr, value):
+        self.write8(lanes, addr, value)
+        self.write8(lanes, addr + 1, value >> 8)
+
+    def dpush(self, lanes, value):
+        self.dsp[lanes] = (self.dsp[lanes] + 1) & self._dmask
+        self.ds[lanes, self.dsp[lanes]] = value & 0xffff
+
+    def rpush(self, lanes, value):
+        self.rsp[lanes] = (self.rsp[lanes] + 1) & self._rmask
+        self.rs[lanes, self.rsp[lanes]] = value & 0xffff
+
+    def dpop(self, lanes):
+        dat = self.ds[lanes, self.dsp[lanes]]
+        self.dsp[lanes] = (self.dsp[lanes] - 1) & self._dmask
+        return dat
+
+    def rpop(self, lanes):
+        dat = self.rs[lanes, self.rsp[lanes]]
+        self.rsp[lanes] = (self.rsp[lanes] - 1) & self._rmask
+        return dat
+
+    def T(self, lanes=slice(None)):
+        return self.ds[np.arange(self.n)[lanes], self.dsp[lanes]]
+
+    def N(self, lanes=slice(None)):
+        return self.ds[np.arange(self.n)[lanes], (self.dsp[lanes] - 1) & self._dmask]
+
+    def R(self, lanes=slice(None)):
+        return self.rs[np.arange(self.n)[lanes], self.rsp[lanes]]
+
+    def opNop(self, L):
+        pass
+
+    def opCall(self, L):
+        self.rpush(L, self.pc[L])
+        self.pc[L] = self.dpop(L)
+        return True
+
+    def opJp(self, L):
+        self.pc[L] = self.dpop(L)
+        return True
+
+    def opJz(self, L):
+        (addr, f) = (self.dpop(L), self.dpop(L))
+        self.pc[L] = np.where(f == 0, addr, self.pc[L])
+        return True
+
+    def opAnd(self, L):
+        (T, N) = (self.dpop(L), self.dpop(L))
+        self.dpush(L, N & T)
+
+    def opOr(self, L):
+        (T, N) = (self.dpop(L), self.dpop(L))
+        self.dpush(L, N | T)
+
+    def opXor(self, L):
+        (T, N) = (self.dpop(L), self.dpop(L))
+        self.dpush(L, N ^ T)
+
+    def opNot(self, L):
+        self.dpush(L, ~self.dpop(L))
+
+    def opSr(self, L):
+        T = self.dpop(L)
+        self.dpush(L, T >> 1)
+        self.carry[L] = (T & 1) != 0
+
+    def opSrw(self, L):
+        T = self.dpop(L)
+        self.dpush(L, T >> 8)
+        self.carry[L] = (T & 1) != 0
+
+    def opSl(self, L):
+        T = self.dpop(L)
+        self.dpush(L, T << 1)
+        self.carry[L] = (T & 0x10000) != 0
+
+    def opSlw(self, L):
+        T = self.dpop(L)
+        self.dpush(L, T << 8)
+        self.carry[L] = (T & 0x10000) != 0
+
+    def opAdd(self, L):
+        (T, N) = (self.dpop(L), self.dpop(L))
+        self.dpush(L, N + T)
+        self.carry[L] = (N + T) > 0xffff
+
+    def opSub(self, L):
+        (T, N) = (self.dpop(L), self.dpop(L))
+        self.dpush(L, N - T)
+        self.carry[L] = (N - T) < 0
+
+    def opLts(self, L):
+        (T, N) = (self.dpop(L), self.dpop(L))
+        res = (N ^ 0x8000) < (T ^ 0x8000)
+        self.dpush(L, np.where(res, 0xffff, 0))
+
+    def opLtu(self, L):
+        (T, N) = (self.dpop(L), self.dpop(L))
+        self.dpush(L, np.where(N < T, 0xffff, 0))
+
+    def opSwap(self, L):
+        (T, N) = (self.dpop(L), self.dpop(L))
+        self.dpush(L, T)
+        self.dpush(L, N)
+
+    def opOver(self, L):
+        self.dpush(L, self.ds[L, (self.dsp[L] - 1) & self._dmask])
+
+    def opDup(self, L):
+        self.dpush(L, self.ds[L, self.dsp[L]])
+
+    def opNip(self, L):
+        T = self.dpop(L)
+        self.dpop(L)
+        self.dpush(L, T)
+
+    def opRot(self, L):
+        (T, N, n2) = (self.dpop(L), self.dpop(L), self.dpop(L))
+        self.dpush(L, N)
+        self.dpush(L, T)
+        self.dpush(L, n2)
+
+    def opNrot(self, L):
+        (T, N, n2) = (self.dpop(L), self.dpop(L), self.dpop(L))
+        self.dpush(L, T)
+        self.dpush(L, n2)
+        self.dpush(L, N)
+
+    def opDrop(self, L):
+        self.dpop(L)
+
+    def opRdrop(self, L):
+        self.rpop(L)
+
+    def opCarry(self, L):
+        self.dpush(L, self.carry[L].astype(np.int64))
+
+    def opToR(self, L):
+        self.rpush(L, self.dpop(L))
+
+    def opFromR(self, L):
+        self.dpush(L, self.rpop(L))
+
+    def opInt(self, L):
+        self.rpush(L, self.pc[L])
+        self.pc[L] = Prim.ISR_ADDR
+        return True
+
+    def opFetch(self, L):
+        self.dpush(L, self.read16(L, self.dpop(L)))
+
+    def opByteFetch(self, L):
+        self.dpush(L, self.read8(L, self.dpop(L)))
+
+    def opStore(self, L):
+        (addr, data) = (self.dpop(L), self.dpop(L))
+        self.write16(L, addr, data)
+
+    def opByteStore(self, L):
+        (addr, data) = (self.dpop(L), self.dpop(L))
+        self.write8(L, addr, data)
+
+    def opPush8(self, L):
+        self.dpush(L, self.read8(L, self.pc[L]))
+        self.pc[L] = (self.pc[L] + 1) & 0xffff
+
+    def opPush(self, L):
+        self.dpush(L, self.read16(L, self.pc[L]))
+        self.pc[L] = (self.pc[L] + 2) & 0xffff
+
+    def opBreak(self, L):
+        self.halted[L] = True
+
+    def buildDispatchTable():
+        # same layout as Prim.buildDispatchTable()
+        table = [PrimBatch.opNop] * 128
+        for (name, handler) in vars(PrimBatch).items():
+            if name.startswith("op") and getattr(Prim, name, None) in Prim.DISPATCH:
+                table[Prim.DISPATCH.index(getattr(Prim, name))] = handler
+        table[PrimOpcodes.BREAK] = PrimBatch.opBreak
+        return table
+
+    def step(self):
+        # one instruction on every running lane, returns the number of lanes
+        # that executed an instruction
+        L = np.flatnonzero(~self.halted)
+        if len(L) == 0:
+            return 0
+        ir = self.read8(L, self.pc[L])
+        self.pc[L] = (self.pc[L] + 1) & 0xffff
+        self.steps[L] += 1
+        ops = ir & 0x7f
+        for op in np.unique(ops):
+            sel = ops == op
+            lanes = L[sel]
+            if not PrimBatch.DISPATCH[op](self, lanes):
+                ret = lanes[(ir[sel] & 0x80) != 0]
+                if len(ret):
+                    self.pc[ret] = self.rpop(ret)
+        return len(L)
+
+    def run(self, max_steps):
+        # steps until all lanes are halted, at most max_steps times.
+        # Returns the number of steps.
+        for steps in range(max_steps):
+            if self.step() == 0:
+                return steps
+        return max_steps
+
+    def call(self, addr, args=(), max_steps=100000, exit_addr=Consts.AREA):
+        # Calls the word at addr on all lanes. args are pushed in order, each
+        # a value or an array with one value per lane. The word returns to
+        # a BREAK written to exit_addr. Results are left on the data stack.
+        self.mem[:, exit_addr] = PrimOpcodes.BREAK
+        lanes = np.arange(self.n)
+        for a in args:
+            self.dpush(lanes, np.broadcast_to(np.asarray(a, np.int64), (self.n,)))
+        self.rpush(lanes, np.full(self.n, exit_addr, np.int64))
+        self.pc[:] = addr
+        self.halted[:] = False
+        return self.run(max_steps)
+
+    def lane(self, i):
+        # a Prim with the state of lane i
+        cpu = Prim(Memory(self.mem[self.rows(np.array([i]))[0]].tobytes()), ds_size=self._dmask + 1, rs_size=self._rmask + 1)
+        cpu._pc = int(self.pc[i])
+        cpu._ds = [int(v) for v in self.ds[i]]
+        cpu._rs = [int(v) for v in self.rs[i]]
+        cpu._dsp = int(self.dsp[i])
+        cpu._rsp = int(self.rsp[i])
+        cpu._carry = bool(self.carry[i])
+        return cpu
+
+    def laneDiffers(self, i, cpu):
+        # names of the registers of lane i that differ from cpu
+        mem = cpu._mif.ram()
+        lane = self.lane(i)
+        diffs = [name for name in ("_pc", "_ds", "_rs", "_dsp", "_rsp")
+                 if getattr(lane, name) != getattr(cpu, name)]
+        if lane._carry != bool(cpu._carry):
+            diffs.append("_carry")
+        if not self.shared_memory and lane._mif.ram() != mem:
+            diffs.append("memory")
+        return diffs
+
+
+PrimBatch.DISPATCH = PrimBatch.buildDispatchTable()
+
+
+def checkAgainstPrim(lanes=256, max_steps=1000, seed=0, length=256):
+    # Runs random programs on a PrimBatch and lane by lane on Prim.run(),
+    # returns a list of (lane, differing registers).
+    rng = np.random.default_rng(seed)
+    # stack and memory ops are more frequent than in random bytes
+    opcodes = np.array(list(range(PrimOpcodes.BREAK + 1)) +
+        [PrimOpcodes.PUSH8, PrimOpcodes.PUSH, PrimOpcodes.FETCH, PrimOpcodes.STORE,
+         PrimOpcodes.BYTE_FETCH, PrimOpcodes.BYTE_STORE] * 2)
+    code = rng.choice(opcodes, (lanes, length)) | np.where(rng.random((lanes, length)) < 0.05, 0x80, 0)
+    batch = PrimBatch(lanes)
+    batch.mem[:, 0:length] = code
+    initial = batch.mem.copy()
+    batch.run(max_steps)
+    mismatches = []
+    for i in range(lanes):
+        cpu = Prim(Memory(initial[i].tobytes()))
+        (reason, steps) = cpu.run(max_steps)
+        diffs = batch.laneDiffers(i, cpu)
+        if steps != batch.steps[i]:
+            diffs.append("steps")
+        if diffs:
+            mismatches.append((i, diffs))
+    return mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check PrimBatch against Prim with random programs')
+    parser.add_argument("-l", help="Number of lanes", action="store", metavar="<lanes>", type=int, required=False, dest="lanes", default=256)
+    parser.add_argument("-n", help="Number of steps", action="store", metavar="<steps>", type=int, required=False, dest="steps", default=1000)
+    parser.add_argument("-s", help="Random seed", action="store", metavar="<seed>", type=int, required=False, dest="seed", default=0)
+    args = parser.parse_args()
+
+    t = time.perf_counter()
+    mismatches = checkAgainstPrim(args.lanes, args.steps, args.seed)
+    t = time.perf_counter() - t
+    for (lane, diffs) in mismatches:
+        print(f"lane {lane}: {', '.join(diffs)}")
+    print(f"{args.lanes} lanes, {args.steps} steps, {len(mismatches)} mismatches ({t:.3f} s)")
+    return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,128 @@
+#! /usr/bin/env python3
+
+import argparse
+import sys
+import time
+
+from prim import Prim
+from primconsts import *
+from primdecode import PrimDecoded
+import primimage
+from primjit import PrimJit
+from primmem import Mif
+
+def lookupSymbol(tomldata, name):
+    idx = tomldata["symbols"].index(name)
+    mem = tomldata["memory"]
+    return mem[Consts.DICT-idx*2] | (mem[Consts.DICT-idx*2+1] << 8)
+
+
+def setupEntry(cpu, addr):
+    # endless loop calling the word at addr:
+    # [push addr] [call] [push AREA] [jp]
+    stub = [PrimOpcodes.PUSH, addr & 0xff, addr >> 8, PrimOpcodes.CALL,
+            PrimOpcodes.PUSH, Consts.AREA & 0xff, Consts.AREA >> 8, PrimOpcodes.JP]
+    for i,b in enumerate(stub):
+        cpu._mif.write8(Consts.AREA + i, b)
+    cpu._pc = Consts.AREA
+
+
+# Each engine runs the workload until BREAK or until steps instructions
+# are executed and returns (seconds, steps executed, info or None). The
+# bench() loop starts the workload again on a freshly loaded CPU after a
+# BREAK, so only workload instructions are measured (and not e.g. the UART
+# polling loop behind the BREAK). Loading the CPU is not timed.
+
+def benchStep(cpu, steps):
+    t = time.perf_counter()
+    count = 0
+    while count < steps:
+        count += 1
+        if cpu.step() == PrimOpcodes.BREAK:
+            break
+    return (time.perf_counter() - t, count, None)
+
+
+def benchRun(cpu, steps):
+    t = time.perf_counter()
+    (reason, count) = runToBreak(cpu, steps)
+    return (time.perf_counter() - t, count, None)
+
+
+def benchDecoded(cpu, steps):
+    decoded = PrimDecoded(cpu)
+    t = time.perf_counter()
+    (reason, count) = runToBreak(decoded, steps)
+    return (time.perf_counter() - t, count, None)
+
+
+def benchJit(cpu, steps):
+    jit = PrimJit(cpu)
+    t = time.perf_counter()
+    (reason, count) = runToBreak(jit, steps)
+    return (time.perf_counter() - t, count, jit.fused)
+
+
+def runToBreak(engine, steps):
+    # engine.run() until BREAK or steps instructions
+    count = 0
+    while count < steps:
+        (reason, n) = engine.run(steps - count)
+        count += n
+        if reason == Prim.STOP_BREAK:
+            break
+    return (reason, count)
+
+
+ENGINES = {
+    "step": benchStep,
+    "run": benchRun,
+    "decoded": benchDecoded,
+    "jit": benchJit,
+}
+
+
+def bench(makeCpu, steps, engine="step"):
+    # runs the workload of the CPUs from makeCpu() again and again for
+    # steps instructions, returns (seconds, number of runs, engine
+    # specific info or None)
+    (t, runs, fused) = (0, 0, None)
+    while steps > 0:
+        (seconds, count, info) = ENGINES[engine](makeCpu(), steps)
+        t += seconds
+        steps -= count
+        runs += 1
+        if info is not None:
+            fused = (fused or 0) + info
+    info = f"{fused} superinstructions" if fused is not None else None
+    return (t, runs, info)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Prim CPU Benchmark')
+    parser.add_argument("-i", help="Input image file (binary or TOML)", action="store", metavar="<input file>", type=str, required=True, dest="input_filename")
+    parser.add_argument("-u", help="UART input file", action="store", metavar="<input file>", type=str, required=False, dest="uart_filename", default="")
+    parser.add_argument("-e", help="Symbol of word to call repeatedly (default: start at address 0)", action="store", metavar="<symbol>", type=str, required=False, dest="entry", default="")
+    parser.add_argument("-n", help="Number of instructions to execute", action="store", metavar="<steps>", type=int, required=False, dest="steps", default=200000)
+    parser.add_argument("-m", help="Execution engine", action="store", choices=ENGINES.keys(), required=False, dest="engines", default=[], nargs="*")
+    args = parser.parse_args()
+
+    tomldata = primimage.load(args.input_filename)
+    uart_data = None
+    if len(args.uart_filename):
+        with open(args.uart_filename, "rb") as f:
+            uart_data = f.read()
+
+    def makeCpu():
+        cpu = Prim(Mif(tomldata["memory"], uart_rx_init=uart_data))
+        if len(args.entry):
+            setupEntry(cpu, lookupSymbol(tomldata, args.entry))
+        return cpu
+
+    for engine in args.engines or ENGINES.keys():
+        (t, runs, info) = bench(makeCpu, args.steps, engine)
+        print(f"{args.input_filename} ({engine}): {args.steps} instructions ({runs} runs) in {t:.3f} s, {args.steps / t:,.0f} instructions/s" + (f", {info}" if info else ""))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,57 @@
+from prim import MemoryIf
+
+class Breakpoints:
+    # Execute breakpoints and memory watchpoints for Prim.setBreakpoints().
+    # flags has one byte per address. Prim.run() calls hit() only for
+    # addresses with a nonzero flag byte, so breakpoints cost nothing
+    # elsewhere. Watchpoints are implemented by the memory interface (see
+    # MemoryIf.watch()), run() stops after an instruction that hit one.
+    EXEC = 1
+    READ = 2
+    WRITE = 4
+
+    def __init__(self, mif):
+        self.flags = bytearray(0x10000)
+        self.conditions = {} # addr: condition(cpu) -> bool
+        self._mif = mif
+
+    def setExec(self, addr, condition=None):
+        # breakpoint at addr, with a condition(cpu) it only stops if the
+        # condition is true (like lambda cpu: cpu.T() == 0)
+        addr &= 0xffff
+        self.flags[addr] |= Breakpoints.EXEC
+        if condition is None:
+            self.conditions.pop(addr, None)
+        else:
+            self.conditions[addr] = condition
+
+    def clearExec(self, addr):
+        addr &= 0xffff
+        self.flags[addr] &= ~Breakpoints.EXEC
+        self.conditions.pop(addr, None)
+
+    def isExec(self, addr):
+        return (self.flags[addr & 0xffff] & Breakpoints.EXEC) != 0
+
+    def watch(self, addr, size=1, read=False, write=True):
+        # watchpoint on [addr, addr+size), read and write False remove it
+        kinds = (MemoryIf.WATCH_READ if read else 0) | (MemoryIf.WATCH_WRITE if write else 0)
+        for a in range(addr, addr+size):
+            a &= 0xffff
+            self.flags[a] &= Breakpoints.EXEC
+            self.flags[a] |= (Breakpoints.READ if read else 0) | (Breakpoints.WRITE if write else 0)
+        self._mif.watch(addr, size, kinds)
+
+    def execBreakpoints(self):
+        return [a for a in range(0x10000) if self.flags[a] & Breakpoints.EXEC]
+
+    def watchpoints(self):
+        # [(addr, read, write)]
+        return [(a, (f & Breakpoints.READ) != 0, (f & Breakpoints.WRITE) != 0)
+                for (a, f) in enumerate(self.flags) if f & (Breakpoints.READ | Breakpoints.WRITE)]
+
+    def hit(self, cpu, pc):
+        if not self.flags[pc] & Breakpoints.EXEC:
+            return False
+        condition = self.conditions.get(pc)
+        return condition is None or condition(cpu)
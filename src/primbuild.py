@@ -0,0 +1,164 @@
+#! /usr/bin/env python3
+
+import argparse
+from datetime import datetime
+import hashlib
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import primimage
+import tokenforth
+
+# Build driver for the TokenForth images. Each target is compiled from its
+# source against the image of the target it depends on (tokenforth.py -s).
+# The outputs are stored in a cache directory under a key that is the hash
+# of the tools, the source and the key of the dependency, so a target whose
+# source and dependencies did not change is copied from the cache instead
+# of being compiled again, also in other checkouts. Images are written
+# without a date (-nd), so they only depend on their inputs.
+
+# name: (source, name of the target it is compiled against or None)
+TARGETS = {
+    "base": ("base.cf", None),
+    "test": ("test.cf", "base"),
+    "interpreter": ("interpreter.cf", "base"),
+}
+
+# outputs of a target, the cache keeps them under these names
+OUTPUTS = (".tf.img", ".tok.img", ".tok")
+
+CACHE_VERSION = 1
+
+def hashFiles(fns):
+    h = hashlib.sha256()
+    for fn in fns:
+        h.update(os.path.basename(fn).encode() + b"\0")
+        with open(fn, "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+def toolHash():
+    # the modules of this directory that are used to compile
+    d = os.path.dirname(os.path.abspath(__file__))
+    fns = set()
+    for m in list(sys.modules.values()):
+        fn = getattr(m, "__file__", None)
+        if fn and fn.endswith(".py") and os.path.dirname(os.path.abspath(fn)) == d:
+            fns.add(os.path.abspath(fn))
+    return hashFiles(sorted(fns))
+
+
+class Builder:
+    def __init__(self, cachedir, date=False, verbose=False):
+        self.cachedir = cachedir
+        self.date = date # stamp outputs with the current date
+        self.verbose = verbose
+        self.tools = toolHash()
+        self.keys = {} # target name: cache key, for the targets built so far
+
+    def key(self, name):
+        (source, dep) = TARGETS[name]
+        h = hashlib.sha256()
+        h.update(f"{CACHE_VERSION} {self.tools} {name} {source}\0".encode())
+        with open(source, "rb") as f:
+            h.update(f.read())
+        if dep is not None:
+            h.update(f"\0{dep} {self.keys[dep]}".encode())
+        return h.hexdigest()
+
+    def build(self, name):
+        # builds the dependencies first, returns the key of the target
+        if name in self.keys:
+            return self.keys[name]
+        dep = TARGETS[name][1]
+        if dep is not None:
+            self.build(dep)
+        key = self.key(name)
+        t = time.perf_counter()
+        entry = os.path.join(self.cachedir, key)
+        cached = os.path.isdir(entry)
+        if not cached:
+            self.compile(name, entry)
+        for ext in OUTPUTS:
+            self.install(os.path.join(entry, "out" + ext), name + ext)
+        t = time.perf_counter() - t
+        print(f"{name}: {'cached' if cached else 'compiled'} {key[:12]} ({t:.3f} s)")
+        self.keys[name] = key
+        return key
+
+    def compile(self, name, entry):
+        # compiles into a temporary directory in the cache which is then
+        # renamed, so a cache entry is always complete
+        (source, dep) = TARGETS[name]
+        os.makedirs(self.cachedir, exist_ok=True)
+        tmp = tempfile.mkdtemp(dir=self.cachedir, prefix="tmp-")
+        try:
+            out = os.path.join(tmp, "out")
+            cmd = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "tokenforth.py"),
+                   "-s", source, "-o", out + ".tf.img", "-t", out + ".tok.img", "-nd"]
+            if dep is not None:
+                cmd.extend(["-i", dep + ".tf.img"])
+            result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            with open(os.path.join(tmp, "log"), "wb") as f:
+                f.write(result.stdout)
+            if self.verbose or result.returncode != 0:
+                sys.stdout.write(result.stdout.decode(errors="replace"))
+            if result.returncode != 0:
+                raise Exception(f"Compiling {source} failed")
+            with open(out + ".tok", "wb") as f:
+                f.write(bytes(primimage.load(out + ".tok.img")["tokens"]))
+            try:
+                os.rename(tmp, entry)
+            except OSError: # built by someone else in the meantime
+                pass
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    def install(self, src, dst):
+        # copies a cached output, a file that is already up to date is not
+        # touched (and keeps its time stamp)
+        with open(src, "rb") as f:
+            data = f.read()
+        if self.date and dst.endswith(".img"):
+            image = primimage.load(src)
+            image["date"] = datetime.now().strftime('%d.%m.%Y %H:%M:%S')
+            data = primimage.encode(image)
+        try:
+            with open(dst, "rb") as f:
+                if f.read() == data:
+                    return
+        except OSError:
+            pass
+        with open(dst, "wb") as f:
+            f.write(data)
+
+
+def defaultCacheDir():
+    base = os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache"))
+    return os.path.join(base, "prim")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Prim TokenForth build driver')
+    parser.add_argument("targets", help=f"Targets to build ({', '.join(TARGETS)}), all by default", metavar="<target>", nargs="*")
+    parser.add_argument("-c", help=f"Cache directory (default {defaultCacheDir()})", metavar="<cache dir>", action="store", type=str, required=False, dest="cachedir", default=defaultCacheDir())
+    parser.add_argument("-d", help="Write the current date into the images", action="store_true", required=False, dest="date", default=False)
+    parser.add_argument("-v", help="Show the compiler output", action="store_true", required=False, dest="verbose", default=False)
+    args = parser.parse_args()
+
+    for name in args.targets:
+        if name not in TARGETS:
+            parser.error(f"Unknown target '{name}'")
+
+    builder = Builder(args.cachedir, args.date, args.verbose)
+    for name in args.targets or TARGETS:
+        builder.build(name)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
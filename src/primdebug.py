@@ -1,87 +1,56 @@
 #! /usr/bin/env python3
 
 import argparse
+import re
 from blessed import Terminal
 from prim import *
 from primasm import *
+from primbreak import Breakpoints
+import primimage
 from primconsts import *
+from primimap import InstructionMap
+from primjournal import UndoJournal
+from primlits import LiteralIndex
+from primmem import Mif
 import signal
 import sys
-import toml
-import tomlfix
-
-# TODO
-# - step back
-
-
-class Mif(MemoryIf):
-    def __init__(self, init=None, tx=None, uart_rx_init=None):
-        self._mem = bytearray(0x10000)
-        self._resetmem = None
-        self._tx = tx
-        self.uart_fifo_rx = []
-        if init is not None:
-            l = len(init)
-            self._mem[0:l] = init
-            self._resetmem = bytearray(self._mem)
-        if uart_rx_init:
-            self.uart_fifo_rx = list(uart_rx_init)
-
-    def reset(self):
-        if self._resetmem is not None:
-            self._mem = bytearray(self._resetmem)
-
-    def read8(self, addr):
-        addr &= 0xffff
-        if addr == 0xfffe:
-            return len(self.uart_fifo_rx) > 0
-        elif addr == 0xffff:
-            return self.uart_fifo_rx.pop(0) if len(self.uart_fifo_rx) else 0
-        return self._mem[addr]
-
-    def read16(self, addr):
-        return self.read8(addr) | (self.read8(addr+1) << 8)
-
-    def write8(self, addr, value):
-        addr &= 0xffff
-        value &= 0xff
-        if addr == 0xffff:
-            if self._tx is not None:
-                self._tx(value)
-        else:
-            self._mem[addr] = int(value)
-
-    def write16(self, addr, value):
-        self.write8(addr, value & 0xff)
-        self.write8(addr+1, (value >> 8) & 0xff)
-
-    def uart_rx(self, dat):
-        self.uart_fifo_rx.append(dat)
-
+import time
 
 class PrimDebug:
     SHOW_CODE = 0
     SHOW_STACKS = 1
     SHOW_MESSAGES = 2
     SHOW_MEMORY = 3
+    JOURNAL_SIZE = 0x10000 # instructions that can be stepped back
+    FRAME_TIME = 0.05 # screen refresh interval while running (20 Hz)
+    RUN_BATCH = 1000 # instructions between checks of the frame time
+    CODE_RANGE_SHIFT = 4 # disassembly is cached in ranges of 16 bytes
+    CODE_VIEW_MARGIN = 3 # lines below the pc before the code view scrolls
     def __init__(self, cpu, term, symbols=None, numlits=None, strlits=None):
         self.cpu = cpu
         self.cpu._debug = self
+        self.journal = UndoJournal(cpu, PrimDebug.JOURNAL_SIZE)
+        self.cpu.setJournal(self.journal)
         self.term = term
         self.symbolMap = self.genSymbolMap(symbols) # (addr, names) dictionary
         self.symbolNamesDict = dict((name,addr) for addr,name in self.symbolMap.items()) # (name: addr) dictionary
-        self.strlits = strlits if strlits is not None else []
-        self.numlits = numlits if numlits is not None else []
+        self.literals = LiteralIndex(numlits or (), strlits or (), cpu._mif.read8)
+        self.imap = InstructionMap(cpu._mif.ram(), self.symbolMap.keys(), self.literals)
         self.messages = [] # messages shown in message area
         self.input = "" # user input
-        self.breakpoints = set() # active breakpoints
+        self.breakpoints = Breakpoints(cpu._mif) # breakpoints and watchpoints
+        self.cpu.setBreakpoints(self.breakpoints)
         self.silentBreakpoints = set() # silent breakpoints for step-over
+        self.conditionTexts = {} # addr: condition of a breakpoint as entered
         self.run = False
+        self.ips = None # instructions per second while running
         self.memViewAddr = 0
         self.memViewHeight = 16
         self.memViewNumBytes = 8
         self.memViewHightlight = set() # addresses being highlighted in memory view
-        self.cpu._mif._tx = self.uart_rx_cb
+        self.codeCache = {} # range: (bytes of the range, {addr: listing line})
+        self.codeViewStart = None # address of the first line in the code view
+        self.frame = {} # (x, y): string printed there in the last frame
         self.redrawEverything()
         PrimAsm.createLookup()
 
@@ -93,9 +62,10 @@ class PrimDebug:
             symbolMap[addr] = sym
         return symbolMap
 
-    def uart_rx_cb(self, dat):
-        self.appendMessage(f"uart: {chr(dat)} ({dat:02x})")
-        self.redraw.add(PrimDebug.SHOW_MESSAGES)
+    def pollUart(self):
+        for dat in self.cpu._mif.uart.transmitted():
+            self.appendMessage(f"uart: {chr(dat)} ({dat:02x})")
+            self.redraw.add(PrimDebug.SHOW_MESSAGES)
 
     def generateStackViewStr(self, prefix, stack, sp, stacksize, w):
         w -= len(prefix)
@@ -111,24 +81,38 @@ class PrimDebug:
             s += " " * (w - l)
         return s
 
+    def stackViewPrefix(self, name, overflows, underflows):
+        # stack name with the overflow/underflow counts, if there were any
+        if overflows or underflows:
+            return f"{name} (over {overflows}, under {underflows}): "
+        return f"{name}: "
+
     def showDataStack(self, x1, x2, y):
-        s = self.generateStackViewStr("D: ", self.cpu._ds, self.cpu._dsp, Prim.DS_SIZE, x2 - x1)
-        with self.term.location(x=x1, y=y):
-            print(s, end="")
+        prefix = self.stackViewPrefix("D", self.cpu.ds_overflows, self.cpu.ds_underflows)
+        s = self.generateStackViewStr(prefix, self.cpu._ds, self.cpu._dsp, len(self.cpu._ds), x2 - x1)
+        self.printAt(x1, y, s)
 
     def showReturnStack(self, x1, x2, y):
-        s = self.generateStackViewStr("R: ", self.cpu._rs, self.cpu._rsp, Prim.RS_SIZE, x2 - x1)
-        with self.term.location(x=x1, y=y):
-            print(s, end="")
+        prefix = self.stackViewPrefix("R", self.cpu.rs_overflows, self.cpu.rs_underflows)
+        s = self.generateStackViewStr(prefix, self.cpu._rs, self.cpu._rsp, len(self.cpu._rs), x2 - x1)
+        self.printAt(x1, y, s)
 
     def showCurrent(self, x1, x2, y):
         w = x2 - x1 + 1
         pc = self.cpu._pc
         s = f"PC {pc:04x}: {self.disassemble(pc)}"
+        if self.ips is not None:
+            s += f"  ({self.ips:,} instructions/s)"
         l = self.term.length(s)
         if l < w:
             s += " " * (w - l)
-        print(self.term.move_xy(x1, y) + s, end='')
+        self.printAt(x1, y, s)
+
+    def printAt(self, x, y, s):
+        # prints s at x, y unless it is already there from the last frame
+        if self.frame.get((x, y)) != s:
+            self.frame[(x, y)] = s
+            print(self.term.move_xy(x, y) + s, end='')
 
     def instructionLength(self, addr):
         ir = self.cpu._mif.read8(addr) & 0x7f
@@ -139,33 +123,21 @@ class PrimDebug:
         return 1
 
     def addrPrevInstruction(self, addr):
-        if addr > 2:
-            if self.cpu._mif.read8(addr-3) == PrimOpcodes.PUSH:
-                return addr - 3
-        if addr > 1:
-            if self.cpu._mif.read8(addr-2) == PrimOpcodes.PUSH8:
-                return addr - 2
-        return addr - 1
+        # -1 before the first instruction
+        return self.imap.prev(addr)
 
     def addrNextInstruction(self, addr):
+        if self.imap.isStart(addr):
+            return self.imap.next(addr)
         return addr + self.instructionLength(addr)
 
-    def addrInStrLiterals(self, addr):
-        # falls addr in a string literal range?
-        for sladdr in self.strlits:
-            if addr < sladdr:
-                continue
-            # range of string literal (cnt + chars)
-            cnt = self.cpu._mif.read8(sladdr) # read string length
-            if addr < sladdr + cnt + 1:
-                return True
-        return False
-
     def disassemble(self, addr, useSymbols=True):
-        if addr in self.numlits:
-            return f"LIT #{self.cpu._mif.read16(addr):x}"
-        if self.addrInStrLiterals(addr):
-            return "STR-LIT"
+        lit = self.literals.find(addr)
+        if lit is not None:
+            if lit[2] == LiteralIndex.STRING:
+                return "STR-LIT"
+            if lit[0] == addr:
+                return f"LIT #{self.cpu._mif.read16(addr):x}"
         opcode = self.cpu._mif.read8(addr)
         (ir, retbit) = (opcode & 0x7f, opcode & 0x80)
         s = PrimAsm.LOOKUP[ir] + (".RET" if retbit else "")
@@ -185,45 +157,80 @@ class PrimDebug:
             s += f" ${val:x}"
         return s
 
+    def listingLine(self, addr):
+        da = f"{addr:04x}:"
+        for b in range(min(self.addrNextInstruction(addr) - addr, 3)):
+            da += f" {self.cpu._mif.read8(addr + b):02x}"
+        da += " " * (16 - len(da))
+        return da + self.disassemble(addr)
+
+    def cachedListingLine(self, addr):
+        # listingLine() cached per code range. A range is dropped when its
+        # bytes (and the 3 bytes following it, which the last instructions
+        # may use) differ from the time it was cached, so writes by the CPU,
+        # the journal or the user are all noticed. Ranges on I/O pages are
+        # not cached. Symbols and literal tables are fixed after loading.
+        mem = self.cpu._mif.ram()
+        shift = PrimDebug.CODE_RANGE_SHIFT
+        start = addr >> shift << shift
+        end = start + (1 << shift) + 3
+        rio = self.cpu._mif.ioPages()[0]
+        if mem is None or end > 0x10000 or rio[start >> MemoryIf.PAGE_SHIFT] or rio[(end - 1) >> MemoryIf.PAGE_SHIFT]:
+            return self.listingLine(addr)
+        data = mem[start:end]
+        cached = self.codeCache.get(start)
+        if cached is None or cached[0] != data:
+            cached = (data, {})
+            self.codeCache[start] = cached
+        line = cached[1].get(addr)
+        if line is None:
+            line = self.listingLine(addr)
+            cached[1][addr] = line
+        return line
+
+    def symbolLine(self, addr):
+        return f"{addr:04x}           " + self.term.red(":" + self.symbolMap[addr])
+
+    def listingFrom(self, addr, lines, h):
+        # appends listing lines from addr on until there are h lines
+        while addr < 0x10000 and len(lines) < h:
+            if addr in self.symbolMap:
+                lines.append(self.symbolLine(addr))
+                if len(lines) == h:
+                    break
+            lines.append(self.cachedListingLine(addr))
+            addr = self.addrNextInstruction(addr)
+        return lines
+
     def showCode(self, x1, y1, x2, y2):
+        # The listing does not scroll while the pc stays away from its end,
+        # so single steps only change the lines of the old and the new pc.
         h = y2 - y1 + 1
         w = x2 - x1 + 1
-        addr = self.cpu._pc
-        linecount = 0
-        lines = []
-        while addr >= 0 and linecount < h // 2:
-            da = f"{addr:04x}:"
-            for b in range(self.instructionLength(addr)):
-                da += f" {self.cpu._mif.read8(addr + b):02x}"
-            da += " " * (16 - len(da))
-            da += self.disassemble(addr)
-            lines.insert(0, da)
-            linecount += 1
-            if addr in self.symbolMap:
-                lines.insert(0, f"{addr:04x}           " + self.term.red(":" + self.symbolMap[addr]))
-                linecount += 1
-            addr = self.addrPrevInstruction(addr)
-        addr = self.addrNextInstruction(self.cpu._pc)
-        while addr < 0x10000 and linecount < h:
-            if addr in self.symbolMap:
-                lines.append(f"{addr:04x}           " + self.term.red(":" + self.symbolMap[addr]))
-                linecount += 1
-            da = f"{addr:04x}:"
-            for b in range(self.instructionLength(addr)):
-                da += f" {self.cpu._mif.read8(addr + b):02x}"
-            da += " " * (16 - len(da))
-            da += self.disassemble(addr)
-            lines.append(da)
-            linecount += 1
-            addr = self.addrNextInstruction(addr)
+        pc = self.cpu._pc
+        lines = None
+        if self.codeViewStart is not None:
+            lines = self.listingFrom(self.codeViewStart, [], h)
+            if not any(int(l[0:4],base=16) == pc for l in lines[:h-PrimDebug.CODE_VIEW_MARGIN]):
+                lines = None
+        if lines is None:
+            addr = pc
+            lines = []
+            while addr >= 0 and len(lines) < h // 2:
+                lines.insert(0, self.cachedListingLine(addr))
+                if addr in self.symbolMap:
+                    lines.insert(0, self.symbolLine(addr))
+                addr = self.addrPrevInstruction(addr)
+            self.listingFrom(self.addrNextInstruction(pc), lines, h)
+            self.codeViewStart = int(lines[0][0:4],base=16)
         for i,l in enumerate(lines):
             # BUG: l might be to long
-            s = self.term.move_xy(x1, y1 + i) + l + " " * (w-self.term.length(l))
+            s = l + " " * (w-self.term.length(l))
             if int(l[0:4],base=16) == self.cpu._pc:
                 s = self.term.reverse(s)
-            if int(l[0:4],base=16) in self.breakpoints:
+            if self.breakpoints.isExec(int(l[0:4],base=16)):
                 s = self.term.blue(s)
-            print(s, end='')
+            self.printAt(x1, y1 + i, s)
 
     def showBox(self, x1, y1, x2, y2):
         w = x2 - x1
@@ -265,10 +272,9 @@ class PrimDebug:
         start = max(0, self.memViewAddr)
         if start + h * self.memViewNumBytes > 0xffff:
             start = 0x10000 - h * self.memViewNumBytes
-        total = ""
         for y in range(h):
             addr = start + y * self.memViewNumBytes
-            s = self.term.move_xy(x1 + 2, y1 + y) + f"{addr:04x}:"
+            s = f"{addr:04x}:"
             chars = ""
             for a in range(self.memViewNumBytes):
                 byteaddr = addr + a
@@ -281,9 +287,7 @@ class PrimDebug:
                     s += f"{val:02x}"
                     chars += (chr(val) if chr(val).isprintable() else '.')
             s = s + " " + chars
-            total += self.term.truncate(s, w-3)
-        print(total, end='')
-        print(self.term.normal, end='')
+            self.printAt(x1 + 2, y1 + y, self.term.truncate(s, w-3) + self.term.normal)
 
     def appendMessage(self, msg=""):
         self.messages.append(msg)
@@ -300,41 +304,113 @@ class PrimDebug:
         for i in range(h):
             if start+i >= num:
                 break
-            print(self.term.move_xy(x1+2,y1+i) + self.messages[start+i][0:w-3], end='')
+            msg = self.messages[start+i][0:w-3]
+            self.printAt(x1+2, y1+i, msg + " " * (w-3-len(msg)))
+
+    def parseAddress(self, s):
+        # symbol or hex address, None if invalid
+        if s in self.symbolNamesDict:
+            return self.symbolNamesDict[s]
+        try:
+            return int(s, 16)
+        except:
+            self.appendMessage(f"Invalid address ${s}")
+            return None
+
+    def parseCondition(self, s):
+        # "T==0", "N<10" etc. (hex values) -> (condition(cpu), description)
+        m = re.fullmatch(r"([TNR])(==|!=|<=|>=|<|>)([0-9a-fA-F]+)", s)
+        if m is None:
+            self.appendMessage(f"Invalid condition {s}")
+            return None
+        (reg, op, value) = (m.group(1), m.group(2), int(m.group(3), 16))
+        get = {"T": Prim.T, "N": Prim.N, "R": Prim.R}[reg]
+        compare = {
+            "==": lambda a: a == value, "!=": lambda a: a != value,
+            "<=": lambda a: a <= value, ">=": lambda a: a >= value,
+            "<": lambda a: a < value, ">": lambda a: a > value,
+        }[op]
+        return (lambda cpu: compare(get(cpu)), s)
 
     def breakpointCmd(self, cmd):
         l = len(cmd)
         if l == 1:
             self.appendMessage("")
-            if len(self.breakpoints) == 0:
+            addrs = self.breakpoints.execBreakpoints()
+            if len(addrs) == 0:
                 self.appendMessage("No breakpoints set.")
             else:
                 self.appendMessage("List of breakpoints:")
-                for bp in self.breakpoints:
+                for bp in addrs:
                     s = f"${bp:x}"
                     if bp in self.symbolMap:
                         s+= " (" + self.symbolMap[bp] + ")"
+                    if bp in self.conditionTexts:
+                        s += " if " + self.conditionTexts[bp]
                     self.appendMessage(s)
-        elif l == 2:
-            if cmd[1] in self.symbolNamesDict:
-                addr = self.symbolNamesDict[cmd[1]]
-            else:
-                try:
-                    addr = int(cmd[1], 16)
-                except:
-                    self.appendMessage(f"Invalid address ${cmd[1]}")
+        elif l in (2, 3):
+            addr = self.parseAddress(cmd[1])
+            if addr is None:
+                return
+            if l == 3:
+                cond = self.parseCondition(cmd[2])
+                if cond is None:
                     return
-            if addr in self.breakpoints:
-                self.breakpoints.remove(addr)
+                self.breakpoints.setExec(addr, cond[0])
+                self.conditionTexts[addr] = cond[1]
+                self.appendMessage(f"Set breakpoint at ${cmd[1]} if {cond[1]}")
+            elif self.breakpoints.isExec(addr):
+                self.breakpoints.clearExec(addr)
+                self.conditionTexts.pop(addr, None)
                 self.appendMessage(f"Removed breakpoint at ${cmd[1]}")
             else:
-                self.breakpoints.add(addr)
+                self.breakpoints.setExec(addr)
                 self.appendMessage(f"Set breakpoint at ${cmd[1]}")
 
+    def watchCmd(self, cmd):
+        l = len(cmd)
+        if l == 1:
+            self.appendMessage("")
+            wps = self.breakpoints.watchpoints()
+            if len(wps) == 0:
+                self.appendMessage("No watchpoints set.")
+            else:
+                self.appendMessage("List of watchpoints:")
+                for (addr, read, write) in wps:
+                    self.appendMessage(f"${addr:x} " + ("r" if read else "") + ("w" if write else ""))
+        else:
+            addr = self.parseAddress(cmd[1])
+            if addr is None:
+                return
+            kinds = cmd[2].lower() if l > 2 else "w"
+            if kinds not in ("r", "w", "rw", "off"):
+                self.appendMessage(f"Invalid watchpoint type {cmd[2]}")
+                return
+            try:
+                size = int(cmd[3], 16) if l > 3 else 2
+            except:
+                self.appendMessage(f"Invalid length {cmd[3]}")
+                return
+            self.breakpoints.watch(addr, size, read="r" in kinds, write="w" in kinds)
+            if kinds == "off":
+                self.appendMessage(f"Removed watchpoint at ${addr:x}")
+            else:
+                self.appendMessage(f"Set {kinds} watchpoint at ${addr:x}, {size} bytes")
+
+    def pollWatchHits(self):
+        hits = self.cpu._mif.watchHits
+        for (addr, kind, value) in hits:
+            access = "read" if kind == MemoryIf.WATCH_READ else "write"
+            self.appendMessage(f"watch: {access} ${addr:04x} = {value:02x} (PC {self.cpu._pc:04x})")
+            self.redraw.add(PrimDebug.SHOW_MESSAGES)
+        hits.clear()
+
     def redrawEverything(self):
         self.redraw = set((PrimDebug.SHOW_CODE, PrimDebug.SHOW_STACKS, PrimDebug.SHOW_MESSAGES, PrimDebug.SHOW_MEMORY))
 
     def show(self):
+        self.pollUart()
+        self.pollWatchHits()
         x2_code = min(self.term.width // 2, 45)
         code = PrimDebug.SHOW_CODE in self.redraw
         mem = PrimDebug.SHOW_MEMORY in self.redraw
@@ -342,6 +418,7 @@ class PrimDebug:
         stacks = PrimDebug.SHOW_STACKS in self.redraw
         if len(self.redraw) == 4:
             print(self.term.clear, end='')
+            self.frame = {}
             self.showBox(0, 0, self.term.width, self.term.height-1)
             print(self.term.move_xy(2, 0) + " Prim Debugger ", end='')
             self.showHorizontalSplitline(0, self.term.width, self.term.height - 7)
@@ -349,6 +426,7 @@ class PrimDebug:
             self.showHorizontalSplitline(0, self.term.width, self.term.height - 3)
             self.showHorizontalSplitline(x2_code + 1, self.term.width, 2+self.memViewHeight)
         if code:
+            self.imap.sync()
             self.showCode(2, 1, x2_code, self.term.height-8)
         if stacks:
             self.showDataStack(2, self.term.width - 2, self.term.height-6)
@@ -361,19 +439,27 @@ class PrimDebug:
         self.showPrompt(2, self.term.width - 2, self.term.height - 2)
         sys.stdout.flush()
         self.redraw = set()
+        # reads by the views are no watch hits
+        self.cpu._mif.watchHits.clear()
 
     def printHelp(self):
         self.appendMessage('Available commands:')
         self.appendMessage()
         self.appendMessage('"break [addr|symbol]"  Set/remove/list breakpoints')
+        self.appendMessage('"break <addr> T==<n>"  Breakpoint with condition on T, N or R')
+        self.appendMessage('                       (==, !=, <, >, <=, >=)')
+        self.appendMessage('"watch [addr] [r|w|rw|off] [len]"')
+        self.appendMessage('                       Set/remove/list watchpoints')
         self.appendMessage('"reset"                Reset CPU and memory')
         self.appendMessage('"run"                  Run program')
+        self.appendMessage('"rc"                   Run backwards to a breakpoint')
         self.appendMessage('"view <addr>"          Set memory view address')
         self.appendMessage('"hl [addr] [len]"      (Un-)highlight range in memory view')
         self.appendMessage('"r <addr> [len]"       Read from memory')
         self.appendMessage('"w <addr> <byte>..."   Write to memory')
         self.appendMessage()
-        self.appendMessage('LEFT for single step')
+        self.appendMessage('RIGHT for single step')
+        self.appendMessage('LEFT for step back')
         self.appendMessage('DOWN for step over')
         self.appendMessage('Prim mnemonics for direct execution (like "drop")')
         self.appendMessage('Enter number to push on data stack')
@@ -464,6 +550,8 @@ class PrimDebug:
             except:
                 self.appendMessage(f"Invalid hex number {c}")
                 return
+        # the journal cannot undo across changes made here
+        self.journal.clear()
         waddr = addr
         s = ""
         for d in data:
@@ -476,6 +564,8 @@ class PrimDebug:
 
     def userPrimExecute(self, cmd):
         self.redrawEverything()
+        # the journal cannot undo across changes made here
+        self.journal.clear()
         count = 0
         for c in cmd:
             try:
@@ -497,8 +587,9 @@ class PrimDebug:
     def uartSendCmd(self, s):
         s = s.strip()
         s = s[s.index(' ')+1:]
-        for c in s:
-            self.cpu._mif.uart_rx(c)
+        # the journal cannot undo across changes made here
+        self.journal.clear()
+        self.cpu._mif.uart.receive(s.encode())
 
     def userCommand(self):
         cmd = self.input.strip().split(' ')
@@ -508,14 +599,19 @@ class PrimDebug:
         if cmd[0] == "break":
             self.breakpointCmd(cmd)
             self.redraw.add(PrimDebug.SHOW_CODE)
+        elif cmd[0] == "watch":
+            self.watchCmd(cmd)
         elif cmd[0] == "help":
             self.printHelp()
         elif cmd[0] == "run":
             self.run = True
+        elif cmd[0] == "rc":
+            self.reverseContinue()
         elif cmd[0] == "reset":
             self.appendMessage("Reset CPU and memory.")
             self.cpu.reset()
             self.cpu._mif.reset()
+            self.journal.clear()
             self.redrawEverything()
         elif cmd[0] == "view":
             self.setupMemoryView(cmd)
@@ -533,6 +629,23 @@ class PrimDebug:
             self.appendMessage(f'Invalid command "{cmd[0]}"')
         self.redraw.add(PrimDebug.SHOW_MESSAGES)
 
+    def stepBack(self):
+        if not self.journal.undo():
+            self.appendMessage("No more instructions to step back.")
+            self.redraw.add(PrimDebug.SHOW_MESSAGES)
+        self.redraw.add(PrimDebug.SHOW_CODE)
+        self.redraw.add(PrimDebug.SHOW_STACKS)
+        self.redraw.add(PrimDebug.SHOW_MEMORY)
+
+    def reverseContinue(self):
+        (reason, steps) = self.journal.reverseContinue(breakpoints=self.breakpoints)
+        self.cpu._mif.watchHits.clear() # restored bytes are no watch hits
+        if reason == Prim.STOP_BREAK:
+            self.appendMessage(f"Stepped back {steps} instructions to the start of the journal.")
+        else:
+            self.appendMessage(f"Stepped back {steps} instructions to breakpoint.")
+        self.redrawEverything()
+
     def handleInput(self, key):
         if key.code == self.term.KEY_ENTER:
             self.userCommand()
@@ -542,14 +655,33 @@ class PrimDebug:
         elif not key.is_sequence:
             self.input += key
 
-    def onSilentBreakpoint(self):
-        if self.cpu._pc in self.silentBreakpoints:
-            self.silentBreakpoints.remove(self.cpu._pc)
-            return True
-        return False
-
-    def onBreakpoint(self):
-        return self.cpu._pc in self.breakpoints
+    def freeRun(self):
+        # Runs in batches until a breakpoint, a watchpoint, a BREAK
+        # instruction or a key press. The screen is refreshed every FRAME_TIME.
+        stop_at = self.silentBreakpoints
+        frame_start = time.perf_counter()
+        frame_steps = 0
+        while True:
+            (reason, steps) = self.cpu.run(PrimDebug.RUN_BATCH, stop_at)
+            frame_steps += steps
+            if reason != Prim.STOP_BUDGET:
+                break
+            now = time.perf_counter()
+            if now - frame_start >= PrimDebug.FRAME_TIME:
+                self.ips = int(frame_steps / (now - frame_start))
+                (frame_start, frame_steps) = (now, 0)
+                if self.term.kbhit(0):
+                    self.term.inkey()
+                    break
+                self.redraw.add(PrimDebug.SHOW_CODE)
+                self.redraw.add(PrimDebug.SHOW_STACKS)
+                self.redraw.add(PrimDebug.SHOW_MEMORY)
+                self.show()
+        if reason == Prim.STOP_BREAKPOINT:
+            self.silentBreakpoints.discard(self.cpu._pc)
+        self.run = False
+        self.ips = None
+        self.redrawEverything()
 
     def debug(self):
         self.appendMessage("Welcome to Prim CPU Debugger.")
@@ -558,23 +690,14 @@ class PrimDebug:
         self.appendMessage("")
         with self.term.fullscreen(), self.term.cbreak():
             while True:
-                while self.run:
-                    ir = self.cpu.step()
-                    kbhit = self.term.kbhit(0)
-                    bp = self.onSilentBreakpoint() or self.onBreakpoint()
-                    if kbhit or (ir == PrimOpcodes.BREAK) or bp:
-                        if kbhit:
-                            self.term.inkey()
-                        self.run = False
-                        self.redrawEverything()
-                        break
-                    self.redraw.add(PrimDebug.SHOW_CODE)
-                    self.redraw.add(PrimDebug.SHOW_STACKS)
-                    self.show()
+                if self.run:
+                    self.freeRun()
                 self.show()
                 key = self.term.inkey()
                 if key.code == self.term.KEY_ESCAPE or key == '\x04': # 4: ctrl+d
                     break
+                elif key.code == self.term.KEY_LEFT:
+                    self.stepBack()
                 elif key.code == self.term.KEY_RIGHT:
                     self.cpu.step()
                     self.redraw.add(PrimDebug.SHOW_CODE)
@@ -594,8 +717,7 @@ class PrimDebug:
 
 
 def debug(fn, uartfn):
-    tomldata = toml.load(fn)
-    tomldata["symbols"] = tomlfix.workaround(tomldata["symbols"])
+    tomldata = primimage.load(fn)
     term = Terminal()
 
     try:
@@ -605,6 +727,7 @@ def debug(fn, uartfn):
         uart_data = None
 
     cpu = Prim(Mif(tomldata["memory"], uart_rx_init=uart_data))
+    cpu.setStackChecks(True)
     debug = PrimDebug(cpu, term, tomldata["symbols"], tomldata["num-literals"], tomldata["string-literals"])
 
     def on_resize(sig, action):
@@ -617,7 +740,7 @@ def debug(fn, uartfn):
 
 def main():
     parser = argparse.ArgumentParser(description='Prim Debugger')
-    parser.add_argument("-i", help="Input TOML file", action="store", metavar="<input file>", type=str, required=False, dest="input_filename",default="src/interpreter.tf.toml")
+    parser.add_argument("-i", help="Input image file (binary or TOML)", action="store", metavar="<input file>", type=str, required=False, dest="input_filename",default="src/interpreter.tf.img")
     parser.add_argument("-u", help="UART input file", action="store", metavar="<input file>", type=str, required=False, dest="uart_filename",default="src/test.tok")
     args = parser.parse_args()
 
@@ -0,0 +1,186 @@
+from array import array
+from prim import Prim, MemoryIf
+from primconsts import *
+
+class PrimDecoded:
+    # Decode-free interpreter for a Prim instance.
+    # The memory image is decoded once into parallel arrays indexed by
+    # address: opcode byte, immediate value and address of the following
+    # instruction. run() executes from these arrays instead of fetching and
+    # assembling bytes on every step.
+    # Stores mark the entries covering the written bytes as UNDECODED, these
+    # addresses are decoded again from RAM when they are executed next.
+    # Instructions that cannot be decoded (code on I/O pages, opcode byte
+    # 0xff) are executed by the byte interpreter Prim.run(). Memory written
+    # by the host has to be announced with invalidate().
+    UNDECODED = 0xff
+
+    def __init__(self, cpu):
+        self.cpu = cpu
+        self._ops = array('B', bytes(0x10000)) # opcode byte or UNDECODED
+        self._imms = array('H', bytes(0x20000)) # immediate of PUSH/PUSH8
+        self._nexts = array('H', bytes(0x20000)) # address of the next instruction
+        mif = cpu._mif
+        mem = mif.ram()
+        if mem is None:
+            (rio, wio) = (MemoryIf.ALL_IO, MemoryIf.ALL_IO)
+        else:
+            (rio, wio) = mif.ioPages()
+        self._mem = mem
+        self._rio = rio
+        self._wio = wio
+        self.invalidate()
+        for addr in range(0x10000):
+            self.decode(addr)
+
+    def invalidate(self, addr=0, size=0x10000):
+        # forget the decoded instructions overlapping [addr, addr+size)
+        ops = self._ops
+        for a in range(addr - 2, addr + min(size, 0x10000)):
+            ops[a & 0xffff] = PrimDecoded.UNDECODED
+
+    def decode(self, addr):
+        # decodes the instruction at addr from RAM, returns its opcode byte
+        # or UNDECODED
+        mem = self._mem
+        shift = MemoryIf.PAGE_SHIFT
+        if mem is None or self._rio[addr >> shift]:
+            return PrimDecoded.UNDECODED
+        ir = mem[addr]
+        op = ir & 0x7f
+        a1 = (addr + 1) & 0xffff
+        a2 = (addr + 2) & 0xffff
+        if op == PrimOpcodes.PUSH8:
+            if self._rio[a1 >> shift]:
+                return PrimDecoded.UNDECODED
+            (imm, nextpc) = (mem[a1], a2)
+        elif op == PrimOpcodes.PUSH:
+            if self._rio[a1 >> shift] or self._rio[a2 >> shift]:
+                return PrimDecoded.UNDECODED
+            (imm, nextpc) = (mem[a1] | (mem[a2] << 8), (addr + 3) & 0xffff)
+        else:
+            (imm, nextpc) = (0, a1)
+        self._imms[addr] = imm
+        self._nexts[addr] = nextpc
+        self._ops[addr] = ir
+        return ir
+
+    def interpret(self, max_steps, stop_at=()):
+        # single steps through Prim.run(). Stores write to the address in T,
+        # so the entries at T are dropped whatever the instruction was.
+        cpu = self.cpu
+        steps = 0
+        while steps < max_steps:
+            addr = cpu.T()
+            (reason, n) = cpu.run(1, stop_at)
+            steps += n
+            self.invalidate(addr, 2)
+            if reason != Prim.STOP_BUDGET:
+                return (reason, steps)
+        return (Prim.STOP_BUDGET, steps)
+
+    def run(self, max_steps, stop_at=()):
+        # same contract as Prim.run()
+        cpu = self.cpu
+        if cpu._stepwise or cpu._breakpoints is not None or cpu._mif.watching():
+            # only Prim.run() stops at breakpoints and watchpoints
+            return self.interpret(max_steps, stop_at)
+        dispatch = Prim.DISPATCH
+        mif = cpu._mif
+        (mem, rio, wio) = (self._mem, self._rio, self._wio)
+        (ops, imms, nexts) = (self._ops, self._imms, self._nexts)
+        shift = MemoryIf.PAGE_SHIFT
+        (read8, read16, write8, write16) = (mif.read8, mif.read16, mif.write8, mif.write16)
+        dpush = cpu.dpush
+        dpop = cpu.dpop
+        rpush = cpu.rpush
+        rpop = cpu.rpop
+        decode = self.decode
+        UNDECODED = PrimDecoded.UNDECODED
+        (PUSH8, PUSH, CALL, JP, JZ, BREAK) = (PrimOpcodes.PUSH8, PrimOpcodes.PUSH,
+            PrimOpcodes.CALL, PrimOpcodes.JP, PrimOpcodes.JZ, PrimOpcodes.BREAK)
+        (FETCH, STORE, BYTE_FETCH, BYTE_STORE) = (PrimOpcodes.FETCH, PrimOpcodes.STORE,
+            PrimOpcodes.BYTE_FETCH, PrimOpcodes.BYTE_STORE)
+        pc = cpu._pc
+        steps = 0
+        reason = Prim.STOP_BUDGET
+        while steps < max_steps:
+            ir = ops[pc]
+            if ir == UNDECODED:
+                ir = decode(pc)
+                if ir == UNDECODED:
+                    # single step in the byte interpreter, it may store
+                    # to the address in T
+                    cpu._pc = pc
+                    addr = cpu.T()
+                    (reason, n) = cpu.run(1)
+                    self.invalidate(addr, 2)
+                    pc = cpu._pc
+                    steps += n
+                    if reason == Prim.STOP_BREAK:
+                        break
+                    reason = Prim.STOP_BUDGET
+                    if pc in stop_at:
+                        reason = Prim.STOP_BREAKPOINT
+                        break
+                    continue
+            steps += 1
+            op = ir & 0x7f
+            if op == PUSH or op == PUSH8:
+                dpush(imms[pc])
+                pc = rpop() if ir & 0x80 else nexts[pc]
+            elif op == CALL:
+                rpush(nexts[pc])
+                pc = dpop()
+            elif op == JP:
+                pc = dpop()
+            elif op == JZ:
+                (addr, f) = (dpop(), dpop())
+                pc = addr if f == 0 else nexts[pc]
+            elif op == FETCH:
+                addr = dpop()
+                a1 = (addr + 1) & 0xffff
+                if rio[addr >> shift] or rio[a1 >> shift]:
+                    dpush(read16(addr))
+                else:
+                    dpush(mem[addr] | (mem[a1] << 8))
+                pc = rpop() if ir & 0x80 else nexts[pc]
+            elif op == STORE:
+                (addr, data) = (dpop(), dpop())
+                a1 = (addr + 1) & 0xffff
+                if wio[addr >> shift] or wio[a1 >> shift]:
+                    write16(addr, data)
+                else:
+                    mem[addr] = data & 0xff
+                    mem[a1] = data >> 8
+                ops[addr] = ops[a1] = ops[(addr - 1) & 0xffff] = ops[(addr - 2) & 0xffff] = UNDECODED
+                pc = rpop() if ir & 0x80 else nexts[pc]
+            elif op == BYTE_FETCH:
+                addr = dpop()
+                dpush((read8(addr) & 0xff) if rio[addr >> shift] else mem[addr])
+                pc = rpop() if ir & 0x80 else nexts[pc]
+            elif op == BYTE_STORE:
+                (addr, data) = (dpop(), dpop())
+                if wio[addr >> shift]:
+                    write8(addr, data)
+                else:
+                    mem[addr] = data & 0xff
+                ops[addr] = ops[(addr - 1) & 0xffff] = ops[(addr - 2) & 0xffff] = UNDECODED
+                pc = rpop() if ir & 0x80 else nexts[pc]
+            elif op == BREAK:
+                pc = rpop() if ir & 0x80 else nexts[pc]
+                reason = Prim.STOP_BREAK
+                break
+            else:
+                cpu._pc = nexts[pc]
+                if dispatch[op](cpu):
+                    pc = cpu._pc
+                elif ir & 0x80:
+                    pc = rpop()
+                else:
+                    pc = cpu._pc
+            if pc in stop_at:
+                reason = Prim.STOP_BREAKPOINT
+                break
+        cpu._pc = pc
+        return (reason, steps)
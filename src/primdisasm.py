@@ -2,11 +2,11 @@
 
 import argparse
 import sys
-import toml
-import tomlfix
+import primimage
 
 from primasm import PrimAsm
 from primconsts import *
+from primlits import LiteralIndex
 
 def nextOpIsCall(data, i):
     return (i < len(data)) and (data[i] == PrimOpcodes.CALL)
@@ -22,9 +22,8 @@ def disassembleOpcode(opcode):
 
 def disassemble(td, out_fn):
     data = td["memory"]
-    strlits = td["string-literals"]
-    numlits = td["num-literals"]
-    symbols = tomlfix.workaround(td["symbols"])
+    literals = LiteralIndex(td["num-literals"], td["string-literals"], data.__getitem__)
+    symbols = td["symbols"]
 
     symbolMap = {}
     for idx,sym in enumerate(symbols):
@@ -40,7 +39,8 @@ def disassemble(td, out_fn):
     while i < len(data):
         if i in symbolMap:
             f.write(f"{i:04x}:                :{symbolMap[i]}\n")
-        if i in strlits:
+        lit = literals.find(i)
+        if lit is not None and lit[0] == i and lit[2] == LiteralIndex.STRING:
             l = data[i]
             s = '"' + bytes(data[i+1:i+1+l]).decode() + '"'
             f.write(f"{i:04x}:   ")
@@ -49,7 +49,7 @@ def disassemble(td, out_fn):
             f.write(f"\t{s}\n")
             i += l + 1
             continue
-        if i in numlits:
+        if lit is not None and lit[0] == i and lit[2] == LiteralIndex.NUMBER:
             num = data[i] | (data[i+1] << 8)
             if num in symbolMap:
                 s = f"{symbolMap[num]}"
@@ -96,12 +96,12 @@ def disassemble(td, out_fn):
 
 def main():
     parser = argparse.ArgumentParser(description='Prim Disassembler')
-    parser.add_argument("-i", help="Input file", action="store", metavar="<toml input file>", type=str, required=False, dest="input_filename",default="src/test.tf.toml")
-    parser.add_argument("-o", help="Output filename", metavar="<output filename>", action="store", type=str, required=False, dest="output_filename",default="src/test.tf.toml.disasm")
+    parser.add_argument("-i", help="Input file", action="store", metavar="<image file>", type=str, required=False, dest="input_filename",default="src/test.tf.img")
+    parser.add_argument("-o", help="Output filename", metavar="<output filename>", action="store", type=str, required=False, dest="output_filename",default="src/test.tf.disasm")
 
     args = parser.parse_args()
 
-    tomldata = toml.load(args.input_filename)
+    tomldata = primimage.load(args.input_filename)
 
     disassemble(tomldata, args.output_filename)
 
@@ -0,0 +1,146 @@
+#! /usr/bin/env python3
+
+import argparse
+import json
+import mmap
+import re
+import struct
+import sys
+import toml
+import tomlfix
+
+# Binary container for the data of the tokenizer and tokenforth TOML files.
+#
+# header:   magic "PRIMIMG\0", version (u16), number of sections (u16)
+# table:    per section: tag (4 bytes), offset (u32), size (u32)
+# sections: "META" JSON object with the scalar entries (title, date, ...)
+#           "SYMS" symbol names, utf-8, separated by NUL bytes
+#           "SLIT" string literal addresses (u16 each)
+#           "NLIT" number literal addresses (u16 each)
+#           "TOKS" token bytes
+#           "MEM " memory size (u32), number of ranges (u32), per range:
+#                  start (u32), length (u32), bytes
+# All numbers are little endian. Only the memory ranges that are not zero
+# are stored.
+#
+# load() detects the format, save() writes TOML if the file name ends with
+# ".toml" and the binary format otherwise.
+
+MAGIC = b"PRIMIMG\0"
+VERSION = 1
+HEADER = struct.Struct("<8sHH")
+ENTRY = struct.Struct("<4sII")
+RANGE = struct.Struct("<II")
+MERGE_GAP = 16 # zero bytes that do not split a memory range
+
+def isBinary(fn):
+    with open(fn, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+def load(fn):
+    # dict with the same entries as the TOML files
+    if not isBinary(fn):
+        data = toml.load(fn)
+        if "symbols" in data:
+            data["symbols"] = tomlfix.workaround(data["symbols"])
+        return data
+    with open(fn, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return decode(memoryview(mm))
+
+def unpack16(buf):
+    return list(struct.unpack(f"<{len(buf) // 2}H", buf))
+
+def pack16(values):
+    return struct.pack(f"<{len(values)}H", *values)
+
+def decode(buf):
+    (magic, version, count) = HEADER.unpack_from(buf, 0)
+    if magic != MAGIC or version != VERSION:
+        raise Exception(f"Unsupported image format (version {version})")
+    sections = {}
+    for i in range(count):
+        (tag, offset, size) = ENTRY.unpack_from(buf, HEADER.size + i * ENTRY.size)
+        sections[tag] = buf[offset:offset+size]
+    data = json.loads(bytes(sections.get(b"META", b"{}")))
+    if b"SYMS" in sections:
+        syms = bytes(sections[b"SYMS"]).decode("utf-8")
+        data["symbols"] = syms.split("\0") if len(syms) else []
+    if b"SLIT" in sections:
+        data["string-literals"] = unpack16(sections[b"SLIT"])
+    if b"NLIT" in sections:
+        data["num-literals"] = unpack16(sections[b"NLIT"])
+    if b"TOKS" in sections:
+        data["tokens"] = list(sections[b"TOKS"])
+    if b"MEM " in sections:
+        data["memory"] = decodeMemory(sections[b"MEM "])
+    return data
+
+def decodeMemory(buf):
+    (size, count) = RANGE.unpack_from(buf, 0)
+    mem = bytearray(size)
+    pos = RANGE.size
+    for i in range(count):
+        (start, length) = RANGE.unpack_from(buf, pos)
+        pos += RANGE.size
+        mem[start:start+length] = buf[pos:pos+length]
+        pos += length
+    return mem
+
+def encodeMemory(mem):
+    mem = bytes(mem)
+    ranges = []
+    start = 0
+    for gap in re.finditer(b"\\0{%d,}" % MERGE_GAP, mem):
+        if gap.start() > start:
+            ranges.append((start, mem[start:gap.start()]))
+        start = gap.end()
+    if start < len(mem):
+        ranges.append((start, mem[start:]))
+    out = [RANGE.pack(len(mem), len(ranges))]
+    for (start, chunk) in ranges:
+        out.append(RANGE.pack(start, len(chunk)))
+        out.append(chunk)
+    return b"".join(out)
+
+def encode(data):
+    meta = dict((k, v) for (k, v) in data.items() if isinstance(v, str))
+    sections = [(b"META", json.dumps(meta).encode("utf-8"))]
+    if "symbols" in data:
+        sections.append((b"SYMS", "\0".join(data["symbols"]).encode("utf-8")))
+    if "string-literals" in data:
+        sections.append((b"SLIT", pack16(data["string-literals"])))
+    if "num-literals" in data:
+        sections.append((b"NLIT", pack16(data["num-literals"])))
+    if "tokens" in data:
+        sections.append((b"TOKS", bytes(data["tokens"])))
+    if "memory" in data:
+        sections.append((b"MEM ", encodeMemory(data["memory"])))
+    offset = HEADER.size + len(sections) * ENTRY.size
+    out = [HEADER.pack(MAGIC, VERSION, len(sections))]
+    for (tag, content) in sections:
+        out.append(ENTRY.pack(tag, offset, len(content)))
+        offset += len(content)
+    out.extend(content for (tag, content) in sections)
+    return b"".join(out)
+
+def save(fn, data):
+    if fn.endswith(".toml"):
+        with open(fn, mode="wt") as f:
+            f.write(toml.dumps(data))
+    else:
+        with open(fn, mode="wb") as f:
+            f.write(encode(data))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Prim image converter (binary <-> TOML)')
+    parser.add_argument("-i", help="Input file (binary image or TOML)", action="store", metavar="<input file>", type=str, required=True, dest="input_filename")
+    parser.add_argument("-o", help="Output file, TOML if it ends with .toml", metavar="<output filename>", action="store", type=str, required=True, dest="output_filename")
+    args = parser.parse_args()
+
+    save(args.output_filename, load(args.input_filename))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,104 @@
+from array import array
+from primconsts import *
+from primlits import LiteralIndex
+
+class InstructionMap:
+    # Instruction boundaries of a memory image, found by a linear sweep
+    # over the whole image. Definitions and literals are anchors: a literal
+    # is one item, and instructions are cut short where an anchor starts.
+    # For every address, _prev and _next hold the start of the item before
+    # and after it, so prev() and next() are table lookups.
+    # sync() compares the image with the copy the map was built from and
+    # sweeps again from the first changed item until the boundaries line up
+    # with the old ones.
+    SYNC_CHUNK = 0x400
+
+    def __init__(self, mem, definitions=(), literals=None):
+        # mem is the 64k image (a bytearray like MemoryIf.ram())
+        self._mem = mem
+        self._copy = bytearray(mem)
+        self._literals = literals if literals is not None else LiteralIndex()
+        self._anchors = bytearray(0x10000)
+        for addr in definitions:
+            self._anchors[addr & 0xffff] = 1
+        for (start, end, kind) in self._literals.ranges():
+            self._anchors[start & 0xffff] = 1
+        self._starts = bytearray(0x10000)
+        self._prev = array('l', [0]) * 0x10000
+        self._next = array('l', [0]) * 0x10000
+        self._sweep(0, 0x10000)
+        self._link(0, 0x10000)
+
+    def _itemEnd(self, addr):
+        lit = self._literals.find(addr)
+        if lit is not None and lit[0] == addr:
+            return min(lit[1], 0x10000)
+        ir = self._copy[addr] & 0x7f
+        end = addr + (3 if ir == PrimOpcodes.PUSH else 2 if ir == PrimOpcodes.PUSH8 else 1)
+        for a in range(addr + 1, min(end, 0x10000)):
+            if self._anchors[a]:
+                return a
+        return min(end, 0x10000)
+
+    def _sweep(self, addr, stop):
+        # marks the items from addr on until an old start at or after stop
+        # is reached, returns the address where the sweep ended
+        starts = self._starts
+        while addr < 0x10000 and not (addr >= stop and starts[addr]):
+            end = self._itemEnd(addr)
+            starts[addr] = 1
+            starts[addr+1:end] = bytes(end - addr - 1)
+            addr = end
+        return addr
+
+    def _link(self, first, last):
+        # fills _prev and _next for [first, last], the starts outside of
+        # this range must not have changed
+        (starts, prev, nxt) = (self._starts, self._prev, self._next)
+        last = min(last, 0xffff)
+        p = prev[first] if first > 0 else -1
+        for a in range(first, last + 1):
+            prev[a] = p
+            if starts[a]:
+                p = a
+        if last == 0xffff:
+            n = 0x10000
+        else:
+            n = last + 1 if starts[last + 1] else nxt[last + 1]
+        for a in range(last, first - 1, -1):
+            nxt[a] = n
+            if starts[a]:
+                n = a
+
+    def update(self, addr, size=1):
+        # the bytes in [addr, addr+size) of the copy have changed
+        start = addr if self._starts[addr] else max(self._prev[addr], 0)
+        end = self._sweep(start, addr + size)
+        self._link(max(self._prev[start], 0), end)
+
+    def sync(self):
+        # catches up with writes to the image, returns True if any bytes
+        # changed
+        (mem, copy) = (self._mem, self._copy)
+        if mem == copy:
+            return False
+        n = InstructionMap.SYNC_CHUNK
+        for c in range(0, 0x10000, n):
+            if mem[c:c+n] == copy[c:c+n]:
+                continue
+            for a in range(c, c + n):
+                if mem[a] != copy[a]:
+                    copy[a] = mem[a]
+                    self.update(a)
+        return True
+
+    def isStart(self, addr):
+        return self._starts[addr & 0xffff] != 0
+
+    def prev(self, addr):
+        # start of the item before addr, -1 if there is none
+        return self._prev[addr & 0xffff]
+
+    def next(self, addr):
+        # start of the item after addr, 0x10000 at the end of memory
+        return self._next[addr & 0xffff]
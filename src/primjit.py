@@ -0,0 +1,395 @@
+import argparse
+import random
+import sys
+
+from prim import Prim, MemoryIf
+from primconsts import *
+from primmem import Memory
+
+class Block:
+    def __init__(self, start, end, length, func, inner, fused):
+        self.start = start # address of the first instruction
+        self.end = end # address behind the last byte
+        self.length = length # number of instructions
+        self.func = func # func(cpu) -> (pc, steps)
+        self.inner = inner # addresses of all instructions but the first
+        self.fused = fused # fused[n]: fused pairs within the first n instructions
+
+
+class PrimJit:
+    # Basic block translation cache for a Prim instance.
+    # A basic block starting at a pc is decoded once, translated into Python
+    # source, compiled and cached by its start address. Blocks end at control
+    # flow (CALL, JP, JZ or a set return bit). BREAK, INT and code on I/O
+    # pages are never translated and are executed by Prim.run().
+    # Stores into cached code invalidate the affected blocks. Memory written
+    # by the host while blocks are cached has to be announced with
+    # invalidate().
+    # A PUSH/PUSH8 followed by one of FUSABLE is translated as a single
+    # operation on the immediate value (superinstruction), the number of
+    # executed pairs is counted in fused.
+    MAX_BLOCK_LENGTH = 32
+    FUSABLE = (PrimOpcodes.CALL, PrimOpcodes.JP, PrimOpcodes.JZ,
+               PrimOpcodes.FETCH, PrimOpcodes.STORE,
+               PrimOpcodes.BYTE_FETCH, PrimOpcodes.BYTE_STORE)
+
+    def __init__(self, cpu):
+        self.cpu = cpu
+        self._blocks = {} # start address: Block
+        self.fused = 0 # number of executed superinstructions
+        self._codemap = bytearray(0x10000) # nonzero: byte belongs to a cached block
+        self._dmask = cpu._dsmask
+        self._rmask = cpu._rsmask
+        mif = cpu._mif
+        mem = mif.ram()
+        if mem is None:
+            (mem, rio, wio) = (None, MemoryIf.ALL_IO, MemoryIf.ALL_IO)
+        else:
+            (rio, wio) = mif.ioPages()
+        self._mem = mem
+        self._rio = rio
+        self._namespace = {
+            "mem": mem, "rio": rio, "wio": wio, "code": self._codemap,
+            "read8": mif.read8, "read16": mif.read16,
+            "write8": mif.write8, "write16": mif.write16,
+            "invalidate": self.invalidate,
+        }
+
+    def invalidate(self, addr=0, size=0x10000):
+        # drop all cached blocks overlapping [addr, addr+size)
+        end = addr + size
+        if end > 0x10000: # wraps around
+            self.invalidate(0, end - 0x10000)
+        dropped = [b for b in self._blocks.values() if b.start < end and addr < b.end]
+        for b in dropped:
+            del self._blocks[b.start]
+        for b in dropped:
+            self._codemap[b.start:b.end] = bytes(b.end - b.start)
+        for b in self._blocks.values():
+            for d in dropped:
+                if b.start < d.end and d.start < b.end:
+                    self._codemap[b.start:b.end] = b"\x01" * (b.end - b.start)
+                    break
+
+    def readCode(self, addr):
+        if self._mem is None or self._rio[addr >> MemoryIf.PAGE_SHIFT]:
+            return None
+        return self._mem[addr]
+
+    def compileBlock(self, start):
+        # returns the Block starting at start, None if the instruction at
+        # start cannot be translated
+        lines = []
+        addr = start
+        count = 0
+        inner = []
+        fused = [0]
+        ends = False
+        while count < PrimJit.MAX_BLOCK_LENGTH and addr < 0x10000:
+            # blocks end at the top of memory, the pc wraps to 0
+            ir = self.readCode(addr)
+            if ir is None or (ir & 0x7f) in (PrimOpcodes.BREAK, PrimOpcodes.INT):
+                break
+            op = ir & 0x7f
+            size = 3 if op == PrimOpcodes.PUSH else 2 if op == PrimOpcodes.PUSH8 else 1
+            if addr + size > 0x10000:
+                break
+            imm = [self.readCode(addr + i) for i in range(1, size)]
+            if None in imm:
+                break
+            if count > 0:
+                inner.append(addr)
+            nextpc = addr + size
+            ir2 = self.readCode(nextpc) if nextpc < 0x10000 else None
+            if (size > 1 and not (ir & 0x80) and ir2 is not None and (ir2 & 0x7f) in PrimJit.FUSABLE
+                    and count + 2 <= PrimJit.MAX_BLOCK_LENGTH):
+                inner.append(nextpc)
+                count += 2
+                fused.extend([fused[-1], fused[-1] + 1])
+                value = imm[0] | (imm[1] << 8) if size == 3 else imm[0]
+                (body, ends) = self.translateFused(value, ir2, (nextpc + 1) & 0xffff, count)
+                nextpc += 1
+            else:
+                count += 1
+                fused.append(fused[-1])
+                (body, ends) = self.translate(ir, imm, nextpc & 0xffff, count)
+            lines.extend(body)
+            addr = nextpc
+            if ends:
+                break
+        if count == 0:
+            return None
+        if not ends:
+            lines.append(f"pc = {addr & 0xffff}")
+        src = ["def block(cpu):",
+               "    ds = cpu._ds",
+               "    rs = cpu._rs",
+               "    dsp = cpu._dsp",
+               "    rsp = cpu._rsp",
+               "    carry = cpu._carry"]
+        src.extend("    " + l for l in lines)
+        src.extend(["    cpu._dsp = dsp",
+                    "    cpu._rsp = rsp",
+                    "    cpu._carry = carry",
+                    f"    return (pc, {count})"])
+        namespace = dict(self._namespace)
+        exec(compile("\n".join(src), f"<block {start:04x}>", "exec"), namespace)
+        block = Block(start, addr, count, namespace["block"], frozenset(inner), tuple(fused))
+        self._blocks[start] = block
+        self._codemap[start:addr] = b"\x01" * (addr - start)
+        return block
+
+    def dpop(self, var=None):
+        lines = [f"{var} = ds[dsp]"] if var else []
+        return lines + [f"dsp = (dsp - 1) & {self._dmask}"]
+
+    def dpush(self, expr):
+        return [f"dsp = (dsp + 1) & {self._dmask}", f"ds[dsp] = ({expr}) & 0xffff"]
+
+    def rpop(self, var):
+        return [f"{var} = rs[rsp]", f"rsp = (rsp - 1) & {self._rmask}"]
+
+    def rpush(self, expr):
+        return [f"rsp = (rsp + 1) & {self._rmask}", f"rs[rsp] = ({expr}) & 0xffff"]
+
+    def exitOnCodeWrite(self, cond, addr, size, nextpc, count, retbit):
+        # a store into cached code ends the block, the rest of it may be stale
+        if retbit: # block ends here anyway
+            return [f"if {cond}:",
+                    f"    invalidate({addr}, {size})"]
+        return [f"if {cond}:",
+                f"    invalidate({addr}, {size})",
+                "    cpu._dsp = dsp",
+                "    cpu._rsp = rsp",
+                "    cpu._carry = carry",
+                f"    return ({nextpc}, {count})"]
+
+    def translate(self, ir, imm, nextpc, count):
+        # returns (lines, ends_block) for one instruction
+        op = ir & 0x7f
+        ps = MemoryIf.PAGE_SHIFT
+        if op == PrimOpcodes.CALL:
+            return (self.rpush(nextpc) + self.dpop("pc"), True)
+        if op == PrimOpcodes.JP:
+            return (self.dpop("pc"), True)
+        if op == PrimOpcodes.JZ:
+            lines = self.dpop("a") + self.dpop("f")
+            lines.append(f"pc = a if f == 0 else {nextpc}")
+            return (lines, True)
+        binary = {
+            PrimOpcodes.AND: ("N & T", None),
+            PrimOpcodes.OR: ("N | T", None),
+            PrimOpcodes.XOR: ("N ^ T", None),
+            PrimOpcodes.ADD: ("N + T", "(N + T) > 0xffff"),
+            PrimOpcodes.SUB: ("N - T", "(N - T) < 0"),
+            PrimOpcodes.LTS: ("0xffff if (N ^ 0x8000) < (T ^ 0x8000) else 0", None),
+            PrimOpcodes.LTU: ("0xffff if N < T else 0", None),
+        }
+        shifts = {
+            PrimOpcodes.SR: ("T >> 1", "(T & 1) != 0"),
+            PrimOpcodes.SRW: ("T >> 8", "(T & 1) != 0"),
+            PrimOpcodes.SL: ("T << 1", "(T & 0x10000) != 0"),
+            PrimOpcodes.SLW: ("T << 8", "(T & 0x10000) != 0"),
+        }
+        lines = []
+        if op in binary:
+            (expr, carry) = binary[op]
+            lines = self.dpop("T") + self.dpop("N") + self.dpush(expr)
+            if carry:
+                lines.append(f"carry = {carry}")
+        elif op in shifts:
+            (expr, carry) = shifts[op]
+            lines = self.dpop("T") + self.dpush(expr) + [f"carry = {carry}"]
+        elif op == PrimOpcodes.NOT:
+            lines = self.dpop("T") + self.dpush("~T")
+        elif op == PrimOpcodes.SWAP:
+            lines = self.dpop("T") + self.dpop("N") + self.dpush("T") + self.dpush("N")
+        elif op == PrimOpcodes.OVER:
+            lines = [f"v = ds[(dsp - 1) & {self._dmask}]"] + self.dpush("v")
+        elif op == PrimOpcodes.DUP:
+            lines = ["v = ds[dsp]"] + self.dpush("v")
+        elif op == PrimOpcodes.NIP:
+            lines = self.dpop("T") + self.dpop() + self.dpush("T")
+        elif op == PrimOpcodes.ROT:
+            lines = self.dpop("T") + self.dpop("N") + self.dpop("n2") + self.dpush("N") + self.dpush("T") + self.dpush("n2")
+        elif op == PrimOpcodes.NROT:
+            lines = self.dpop("T") + self.dpop("N") + self.dpop("n2") + self.dpush("T") + self.dpush("n2") + self.dpush("N")
+        elif op == PrimOpcodes.DROP:
+            lines = self.dpop()
+        elif op == PrimOpcodes.RDROP:
+            lines = self.rpop("T")
+        elif op == PrimOpcodes.CARRY:
+            lines = self.dpush("carry")
+        elif op == PrimOpcodes.TO_R:
+            lines = self.dpop("T") + self.rpush("T")
+        elif op == PrimOpcodes.FROM_R:
+            lines = self.rpop("T") + self.dpush("T")
+        elif op == PrimOpcodes.FETCH:
+            lines = self.dpop("a")
+            lines += ["a1 = (a + 1) & 0xffff",
+                      f"if rio[a >> {ps}] or rio[a1 >> {ps}]:",
+                      "    v = read16(a)",
+                      "else:",
+                      "    v = mem[a] | (mem[a1] << 8)"]
+            lines += self.dpush("v")
+        elif op == PrimOpcodes.BYTE_FETCH:
+            lines = self.dpop("a")
+            lines += self.dpush(f"read8(a) & 0xff if rio[a >> {ps}] else mem[a]")
+        elif op == PrimOpcodes.STORE:
+            lines = self.dpop("a") + self.dpop("v")
+            lines += ["a1 = (a + 1) & 0xffff",
+                      f"if wio[a >> {ps}] or wio[a1 >> {ps}]:",
+                      "    write16(a, v)",
+                      "else:",
+                      "    mem[a] = v & 0xff",
+                      "    mem[a1] = v >> 8"]
+            lines += self.exitOnCodeWrite("code[a] or code[a1]", "a", 2, nextpc, count, ir & 0x80)
+        elif op == PrimOpcodes.BYTE_STORE:
+            lines = self.dpop("a") + self.dpop("v")
+            lines += [f"if wio[a >> {ps}]:",
+                      "    write8(a, v)",
+                      "else:",
+                      "    mem[a] = v & 0xff"]
+            lines += self.exitOnCodeWrite("code[a]", "a", 1, nextpc, count, ir & 0x80)
+        elif op == PrimOpcodes.PUSH8:
+            lines = self.dpush(imm[0])
+        elif op == PrimOpcodes.PUSH:
+            lines = self.dpush(imm[0] | (imm[1] << 8))
+        if ir & 0x80:
+            return (lines + self.rpop("pc"), True)
+        return (lines, False)
+
+    def interpret(self, max_steps, stop_at=()):
+        # single steps through Prim.run(). Stores write to the address in T,
+        # so blocks at T are dropped whatever the instruction was.
+        cpu = self.cpu
+        code = self._codemap
+        steps = 0
+        while steps < max_steps:
+            addr = cpu.T()
+            (reason, n) = cpu.run(1, stop_at)
+            steps += n
+            if code[addr] or code[(addr + 1) & 0xffff]:
+                self.invalidate(addr, 2)
+            if reason != Prim.STOP_BUDGET:
+                return (reason, steps)
+        return (Prim.STOP_BUDGET, steps)
+
+    def translateFused(self, value, ir, nextpc, count):
+        # returns (lines, ends_block) for PUSH value followed by ir.
+        # The popped immediate is left above the stack pointer, as by the
+        # unfused pair.
+        op = ir & 0x7f
+        ps = MemoryIf.PAGE_SHIFT
+        residue = f"ds[(dsp + 1) & {self._dmask}] = {value}"
+        if op == PrimOpcodes.CALL:
+            return ([residue] + self.rpush(nextpc) + [f"pc = {value}"], True)
+        if op == PrimOpcodes.JP:
+            return ([residue, f"pc = {value}"], True)
+        if op == PrimOpcodes.JZ:
+            return ([residue] + self.dpop("f") + [f"pc = {value} if f == 0 else {nextpc}"], True)
+        a1 = (value + 1) & 0xffff
+        if op == PrimOpcodes.FETCH:
+            lines = [f"if rio[{value >> ps}] or rio[{a1 >> ps}]:",
+                     f"    v = read16({value})",
+                     "else:",
+                     f"    v = mem[{value}] | (mem[{a1}] << 8)"]
+            lines += self.dpush("v")
+        elif op == PrimOpcodes.BYTE_FETCH:
+            lines = self.dpush(f"read8({value}) & 0xff if rio[{value >> ps}] else mem[{value}]")
+        elif op == PrimOpcodes.STORE:
+            lines = [residue] + self.dpop("v")
+            lines += [f"if wio[{value >> ps}] or wio[{a1 >> ps}]:",
+                      f"    write16({value}, v)",
+                      "else:",
+                      f"    mem[{value}] = v & 0xff",
+                      f"    mem[{a1}] = v >> 8"]
+            lines += self.exitOnCodeWrite(f"code[{value}] or code[{a1}]", value, 2, nextpc, count, ir & 0x80)
+        elif op == PrimOpcodes.BYTE_STORE:
+            lines = [residue] + self.dpop("v")
+            lines += [f"if wio[{value >> ps}]:",
+                      f"    write8({value}, v)",
+                      "else:",
+                      f"    mem[{value}] = v & 0xff"]
+            lines += self.exitOnCodeWrite(f"code[{value}]", value, 1, nextpc, count, ir & 0x80)
+        if ir & 0x80:
+            return (lines + self.rpop("pc"), True)
+        return (lines, False)
+
+    def run(self, max_steps, stop_at=()):
+        # same contract as Prim.run()
+        cpu = self.cpu
+        if cpu._stepwise or cpu._stackChecks or cpu._breakpoints is not None or cpu._mif.watching():
+            # translated code neither traces, checks the stacks nor stops
+            # at breakpoints or watchpoints
+            return self.interpret(max_steps, stop_at)
+        blocks = self._blocks
+        steps = 0
+        pc = cpu._pc
+        while steps < max_steps:
+            block = blocks.get(pc) or self.compileBlock(pc)
+            if block is None or steps + block.length > max_steps or (stop_at and not block.inner.isdisjoint(stop_at)):
+                # let the interpreter handle it, up to the end of the block
+                cpu._pc = pc
+                n = block.length if block is not None else 1
+                (reason, n) = self.interpret(min(n, max_steps - steps), stop_at)
+                steps += n
+                pc = cpu._pc
+                if reason != Prim.STOP_BUDGET:
+                    return (reason, steps)
+                continue
+            (pc, n) = block.func(cpu)
+            steps += n
+            self.fused += block.fused[n]
+            if pc in stop_at:
+                cpu._pc = pc
+                return (Prim.STOP_BREAKPOINT, steps)
+        cpu._pc = pc
+        return (Prim.STOP_BUDGET, steps)
+
+
+def checkAgainstPrim(programs=400, max_steps=200, seed=0):
+    # Runs random programs that start near 0xffff and wrap around to 0 on
+    # PrimJit and on Prim.run(), returns a list of (program, differences).
+    rng = random.Random(seed)
+    opcodes = list(range(PrimOpcodes.BREAK + 1)) + [PrimOpcodes.PUSH8, PrimOpcodes.PUSH] * 4
+    mismatches = []
+    for i in range(programs):
+        mem = bytearray(0x10000)
+        for addr in list(range(0xff00, 0x10000)) + list(range(0x100)):
+            mem[addr] = rng.choice(opcodes) | (0x80 if rng.random() < 0.05 else 0)
+        pc = rng.randrange(0xffe0, 0x10000)
+        results = []
+        for engine in (lambda cpu: cpu, PrimJit):
+            cpu = Prim(Memory(mem))
+            cpu._pc = pc
+            try:
+                (reason, steps) = engine(cpu).run(max_steps)
+            except Exception as e:
+                results.append(repr(e))
+                continue
+            results.append({ "reason": reason, "steps": steps, "pc": cpu._pc, "dsp": cpu._dsp, "rsp": cpu._rsp,
+                             "ds": list(cpu._ds), "rs": list(cpu._rs), "carry": cpu._carry, "memory": bytes(cpu._mif.ram()) })
+        (ref, jit) = results
+        if ref != jit:
+            diffs = [k for k in ref if jit[k] != ref[k]] if isinstance(jit, dict) and isinstance(ref, dict) else [str(jit)]
+            mismatches.append((i, diffs))
+    return mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check PrimJit against Prim with random programs at the end of memory')
+    parser.add_argument("-p", help="Number of programs", action="store", metavar="<programs>", type=int, required=False, dest="programs", default=400)
+    parser.add_argument("-n", help="Number of steps", action="store", metavar="<steps>", type=int, required=False, dest="steps", default=200)
+    parser.add_argument("-s", help="Random seed", action="store", metavar="<seed>", type=int, required=False, dest="seed", default=0)
+    args = parser.parse_args()
+
+    mismatches = checkAgainstPrim(args.programs, args.steps, args.seed)
+    for (program, diffs) in mismatches:
+        print(f"program {program}: {', '.join(diffs)}")
+    print(f"{args.programs} programs, {args.steps} steps, {len(mismatches)} mismatches")
+    return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
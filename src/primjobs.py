@@ -0,0 +1,134 @@
+#! /usr/bin/env python3
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import functools
+import os
+import sys
+import toml
+
+from prim import Prim
+import primimage
+from primdecode import PrimDecoded
+from primjit import PrimJit
+from primmem import Mif
+
+class Job:
+    # a program image (.tf.img or .tf.toml) run with UART input for up to
+    # max_steps instructions
+    def __init__(self, image, uart=None, max_steps=1000000):
+        self.image = image # image file name
+        self.uart = uart # UART input file name or None
+        self.max_steps = max_steps
+
+
+class JobResult:
+    # final state of a job, error is None or the message of the exception
+    # that stopped the job
+    def __init__(self, job):
+        self.image = job.image
+        self.uart = job.uart
+        self.reason = None # Prim.STOP_*
+        self.steps = 0
+        self.pc = 0
+        self.ds = []
+        self.rs = []
+        self.carry = False
+        self.uart_tx = b""
+        self.error = None
+
+    def toDict(self):
+        d = dict(vars(self))
+        d["uart"] = self.uart or ""
+        d["uart_tx"] = self.uart_tx.decode("latin-1")
+        d["error"] = self.error or ""
+        if self.reason is None:
+            del d["reason"]
+        return d
+
+
+@functools.lru_cache(maxsize=32)
+def loadImage(fn):
+    # jobs of a worker process often share images
+    return bytes(primimage.load(fn)["memory"])
+
+
+@functools.lru_cache(maxsize=32)
+def loadUart(fn):
+    with open(fn, "rb") as f:
+        return f.read()
+
+
+# execution engines, the JIT only pays off for jobs that run long enough
+# to reuse their translated blocks
+ENGINES = {
+    "run": lambda cpu: cpu,
+    "decoded": PrimDecoded,
+    "jit": PrimJit,
+}
+
+
+def runJob(job, engine="run"):
+    result = JobResult(job)
+    try:
+        uart_data = loadUart(job.uart) if job.uart else None
+        cpu = Prim(Mif(loadImage(job.image), uart_rx_init=uart_data))
+        (result.reason, result.steps) = ENGINES[engine](cpu).run(job.max_steps)
+        result.pc = cpu._pc
+        result.ds = [cpu._ds[(cpu._dsp - i) & cpu._dsmask] for i in range(len(cpu._ds))]
+        result.rs = [cpu._rs[(cpu._rsp - i) & cpu._rsmask] for i in range(len(cpu._rs))]
+        result.carry = bool(cpu._carry)
+        result.uart_tx = cpu._mif.uart.transmitted()
+    except Exception as e:
+        result.error = f"{type(e).__name__}: {e}"
+    return result
+
+
+def runJobs(jobs, workers=None, engine="run"):
+    # Runs the jobs on a pool of worker processes (default: one per core)
+    # with one of the ENGINES, returns the JobResults in the order of jobs.
+    # With workers=1 the jobs are run in this process.
+    jobs = list(jobs)
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(jobs) <= 1:
+        return [runJob(job, engine) for job in jobs]
+    # a few chunks per worker balance uneven jobs without much IPC
+    chunksize = max(1, len(jobs) // (workers * 4))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(functools.partial(runJob, engine=engine), jobs, chunksize=chunksize))
+
+
+def loadJobs(fn):
+    # [[job]] tables with keys image, uart (optional) and steps (optional)
+    jobs = []
+    for j in toml.load(fn).get("job", []):
+        jobs.append(Job(j["image"], j.get("uart") or None, j.get("steps", 1000000)))
+    return jobs
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Prim batch runner')
+    parser.add_argument("-j", help="TOML file with [[job]] tables", action="store", metavar="<jobs file>", type=str, required=False, dest="jobs_filename", default="")
+    parser.add_argument("-i", help="Input image files, one job each", action="store", metavar="<input file>", type=str, required=False, dest="input_filenames", default=[], nargs="*")
+    parser.add_argument("-u", help="UART input file for the -i jobs", action="store", metavar="<input file>", type=str, required=False, dest="uart_filename", default="")
+    parser.add_argument("-n", help="Step budget for the -i jobs", action="store", metavar="<steps>", type=int, required=False, dest="steps", default=1000000)
+    parser.add_argument("-w", help="Number of worker processes (default: number of cores)", action="store", metavar="<workers>", type=int, required=False, dest="workers", default=0)
+    parser.add_argument("-m", help="Execution engine (default: run)", action="store", choices=ENGINES.keys(), required=False, dest="engine", default="run")
+    parser.add_argument("-o", help="Output TOML file for the results", action="store", metavar="<output file>", type=str, required=False, dest="output_filename", default="")
+    args = parser.parse_args()
+
+    jobs = loadJobs(args.jobs_filename) if len(args.jobs_filename) else []
+    jobs += [Job(fn, args.uart_filename or None, args.steps) for fn in args.input_filenames]
+    results = runJobs(jobs, args.workers, args.engine)
+
+    for r in results:
+        status = f"error: {r.error}" if r.error else f"{r.steps} steps, pc {r.pc:04x}, {len(r.uart_tx)} bytes sent"
+        print(f"{r.image} ({r.uart or '-'}): {status}")
+    if len(args.output_filename):
+        with open(args.output_filename, "wt") as f:
+            toml.dump({"result": [r.toDict() for r in results]}, f)
+    return 1 if any(r.error for r in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,130 @@
+from collections import deque
+import sys
+
+from prim import Prim, MemoryIf
+from primasm import PrimAsm
+from primconsts import *
+from primmem import Mif
+
+class UndoJournal:
+    # Undo journal for a Prim instance, records the state an instruction
+    # may change before it is executed by step():
+    # pc, stack pointers and depths, carry, the data stack slots T-2..T+1,
+    # the return stack slot above R and the old bytes of a store target.
+    # Records are kept in a ring buffer of size entries, the oldest ones
+    # are dropped. I/O side effects (UART input consumed, output sent) are
+    # not undone, bytes stored to devices are not recorded.
+
+    def __init__(self, cpu, size=0x10000):
+        self.cpu = cpu
+        self._records = deque(maxlen=size)
+        mif = cpu._mif
+        self._mem = mif.ram()
+        if self._mem is None:
+            self._dev = MemoryIf.ALL_IO
+        else:
+            self._dev = mif.devicePages()
+        self._isDevice = mif.isDevice
+
+    def __len__(self):
+        return len(self._records)
+
+    def clear(self):
+        self._records.clear()
+
+    def record(self):
+        cpu = self.cpu
+        (ds, dsp, dmask) = (cpu._ds, cpu._dsp, cpu._dsmask)
+        pc = cpu._pc
+        store = None
+        # the opcode is read from RAM, read watchpoints on the page must
+        # neither see the access nor stop the recording
+        if not (self._dev[pc >> MemoryIf.PAGE_SHIFT] and self._isDevice(pc)):
+            op = self._mem[pc] & 0x7f
+            if op == PrimOpcodes.STORE:
+                addr = ds[dsp]
+                a1 = (addr + 1) & 0xffff # 0xffff wraps to 0x0000
+                if self._dev[addr >> MemoryIf.PAGE_SHIFT] or self._dev[a1 >> MemoryIf.PAGE_SHIFT]:
+                    store = self.oldBytes((addr, a1))
+                else:
+                    store = ((addr, self._mem[addr]), (a1, self._mem[a1]))
+            elif op == PrimOpcodes.BYTE_STORE:
+                addr = ds[dsp]
+                if self._dev[addr >> MemoryIf.PAGE_SHIFT]:
+                    store = self.oldBytes((addr,))
+                else:
+                    store = ((addr, self._mem[addr]),)
+        self._records.append((pc, dsp, cpu._rsp, cpu._ddepth, cpu._rdepth, cpu._carry,
+            ds[(dsp - 2) & dmask], ds[(dsp - 1) & dmask], ds[dsp], ds[(dsp + 1) & dmask],
+            cpu._rs[(cpu._rsp + 1) & cpu._rsmask], store))
+
+    def oldBytes(self, addrs):
+        # (addr, value) of the bytes of a device page that are RAM, a page
+        # with a device may have RAM next to it
+        return tuple((a, self._mem[a]) for a in addrs if not self._isDevice(a))
+
+    def undo(self):
+        # reverts the last recorded instruction, returns False if there is
+        # none
+        if not self._records:
+            return False
+        cpu = self.cpu
+        (pc, dsp, rsp, ddepth, rdepth, carry, d0, d1, d2, d3, r1, store) = self._records.pop()
+        (ds, dmask) = (cpu._ds, cpu._dsmask)
+        (ds[(dsp - 2) & dmask], ds[(dsp - 1) & dmask], ds[dsp], ds[(dsp + 1) & dmask]) = (d0, d1, d2, d3)
+        cpu._rs[(rsp + 1) & cpu._rsmask] = r1
+        (cpu._pc, cpu._dsp, cpu._rsp, cpu._ddepth, cpu._rdepth, cpu._carry) = (pc, dsp, rsp, ddepth, rdepth, carry)
+        if store is not None:
+            for (addr, value) in store:
+                cpu._mif.write8(addr, value)
+        return True
+
+    def reverseContinue(self, stop_at=(), max_steps=None, breakpoints=None):
+        # undoes instructions until the pc is in stop_at, hits one of the
+        # breakpoints or the journal is empty. Returns (reason, steps) like
+        # Prim.run(), STOP_BREAK means the start of the journal was reached.
+        steps = 0
+        while max_steps is None or steps < max_steps:
+            if not self.undo():
+                return (Prim.STOP_BREAK, steps)
+            steps += 1
+            pc = self.cpu._pc
+            if pc in stop_at or (breakpoints is not None and breakpoints.hit(self.cpu, pc)):
+                return (Prim.STOP_BREAKPOINT, steps)
+        return (Prim.STOP_BUDGET, steps)
+
+
+def checkUndo():
+    # Runs stores from a read-watched page and next to the UART, undoes
+    # them and returns the addresses whose bytes were not restored.
+    I = PrimAsm.INSTRUCTIONS
+    prog = []
+    for (addr, value) in ((0x2000, 0x1234), (0xfff0, 0x5678), (0xfffd, 0x9abc), (0xffff, 0xdef0)):
+        prog += [I["PUSH"], value & 0xff, value >> 8, I["PUSH"], addr & 0xff, addr >> 8, I["!"]]
+    prog += [I["PUSH8"], 0x55, I["PUSH"], 0xf5, 0xff, I["C!"], I["BREAK"]]
+    mem = bytearray(0x10000)
+    mem[0x100:0x100+len(prog)] = bytes(prog)
+    mem[0] = 0x42
+    mif = Mif(mem)
+    mif.watch(0x100, kinds=MemoryIf.WATCH_READ) # code page is read-watched
+    cpu = Prim(mif)
+    cpu._pc = 0x100
+    before = bytes(mif.ram())
+    journal = UndoJournal(cpu)
+    while cpu._mif.ram()[cpu._pc] != PrimOpcodes.BREAK:
+        journal.record()
+        cpu.step()
+    while journal.undo():
+        pass
+    after = bytes(mif.ram())
+    return [a for a in range(0x10000) if before[a] != after[a]]
+
+
+def main():
+    diffs = checkUndo()
+    print(f"undo check: {len(diffs)} bytes not restored" + "".join(f" {a:04x}" for a in diffs))
+    return 1 if diffs else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,49 @@
+from bisect import bisect_right
+
+class LiteralIndex:
+    # Sorted interval index of the literals in a memory image. Number
+    # literals cover 2 bytes, string literals the count byte and the chars.
+    # find() is a binary search over the start addresses, ranges are
+    # expected not to overlap.
+    NUMBER = 0
+    STRING = 1
+
+    def __init__(self, numlits=(), strlits=(), read8=None):
+        # numlits and strlits are the literal addresses as stored in the
+        # TOML files, read8(addr) reads the count byte of a string literal
+        self._starts = [] # sorted start addresses
+        self._ends = [] # end address (exclusive) for each start
+        self._kinds = [] # NUMBER or STRING for each start
+        for addr in numlits:
+            self.addNumber(addr)
+        for addr in strlits:
+            self.addString(addr, read8(addr))
+
+    def __len__(self):
+        return len(self._starts)
+
+    def _add(self, start, end, kind):
+        i = bisect_right(self._starts, start)
+        if i > 0 and self._starts[i-1] == start:
+            (self._ends[i-1], self._kinds[i-1]) = (end, kind)
+            return
+        self._starts.insert(i, start)
+        self._ends.insert(i, end)
+        self._kinds.insert(i, kind)
+
+    def addNumber(self, addr):
+        self._add(addr, addr + 2, LiteralIndex.NUMBER)
+
+    def addString(self, addr, count):
+        self._add(addr, addr + 1 + count, LiteralIndex.STRING)
+
+    def find(self, addr):
+        # (start, end, kind) of the literal covering addr or None
+        i = bisect_right(self._starts, addr) - 1
+        if i >= 0 and addr < self._ends[i]:
+            return (self._starts[i], self._ends[i], self._kinds[i])
+        return None
+
+    def ranges(self):
+        # [(start, end, kind)] sorted by address
+        return list(zip(self._starts, self._ends, self._kinds))
@@ -0,0 +1,241 @@
+from collections import deque
+import weakref
+from prim import MemoryIf
+
+PAGE_SHIFT = MemoryIf.PAGE_SHIFT
+PAGE_SIZE = 1 << PAGE_SHIFT
+
+class MemorySnapshot:
+    # Pages dirtied since the snapshot was taken, with their content at that
+    # time. Pages not in pages are unchanged.
+    def __init__(self):
+        self.pages = {} # page: bytes
+
+class Memory(MemoryIf):
+    # 64k of RAM in a bytearray with memory mapped I/O.
+    # I/O handlers are registered per address with map(). A page table with
+    # one flag per 16 byte page marks the pages containing handlers, all
+    # other pages are plain RAM and are accessed directly. Small pages keep
+    # code next to I/O registers (like the immediate area below the UART)
+    # on the fast path. Page size is MemoryIf.PAGE_SHIFT.
+    # Watched addresses are on I/O pages too, their accesses are appended to
+    # watchHits.
+    # Snapshots are copy on write: snapshot() flags all pages in the write
+    # page table, the first write to a page saves its content into the live
+    # snapshots. Memory changed with init() or directly in ram() is not
+    # tracked.
+
+    def __init__(self, init=None):
+        self._mem = bytearray(0x10000)
+        self._rpages = bytearray(Memory.NUM_PAGES) # pages with read handlers
+        self._wpages = bytearray(Memory.NUM_PAGES) # pages with write handlers or copy on write
+        self._iowpages = bytearray(Memory.NUM_PAGES) # pages with write handlers
+        self._wwatchpages = bytearray(Memory.NUM_PAGES) # pages with write watchpoints
+        self._cowpages = bytearray(Memory.NUM_PAGES) # pages to save before the next write
+        self._snapshots = weakref.WeakSet()
+        self._readers = {} # addr: read(addr) -> value
+        self._writers = {} # addr: write(addr, value)
+        self._watched = {} # addr: WATCH_READ | WATCH_WRITE
+        self.watchHits = []
+        if init is not None:
+            self.init(init)
+
+    def init(self, mem):
+        l = len(mem)
+        for page in range((l + PAGE_SIZE - 1) >> PAGE_SHIFT):
+            if self._cowpages[page]:
+                self.copyOnWrite(page)
+        self._mem[0:l] = mem
+
+    def map(self, addr, read=None, write=None, size=1):
+        # register I/O handlers for the address range [addr, addr+size)
+        for a in range(addr, addr+size):
+            a &= 0xffff
+            if read is not None:
+                self._readers[a] = read
+            if write is not None:
+                self._writers[a] = write
+        self.updatePages()
+
+    def unmap(self, addr, size=1):
+        for a in range(addr, addr+size):
+            self._readers.pop(a & 0xffff, None)
+            self._writers.pop(a & 0xffff, None)
+        self.updatePages()
+
+    def watch(self, addr, size=1, kinds=MemoryIf.WATCH_WRITE):
+        for a in range(addr, addr+size):
+            if kinds:
+                self._watched[a & 0xffff] = kinds
+            else:
+                self._watched.pop(a & 0xffff, None)
+        self.updatePages()
+
+    def updatePages(self):
+        # update in place, the CPU keeps references to the page tables
+        self._rpages[:] = bytes(Memory.NUM_PAGES)
+        self._iowpages[:] = bytes(Memory.NUM_PAGES)
+        self._wwatchpages[:] = bytes(Memory.NUM_PAGES)
+        for a in self._readers:
+            self._rpages[a >> PAGE_SHIFT] = 1
+        for a in self._writers:
+            self._iowpages[a >> PAGE_SHIFT] = 1
+        for (a, kinds) in self._watched.items():
+            if kinds & Memory.WATCH_READ:
+                self._rpages[a >> PAGE_SHIFT] = 1
+            if kinds & Memory.WATCH_WRITE:
+                self._wwatchpages[a >> PAGE_SHIFT] = 1
+        self._wpages[:] = bytes(w | c | ww for (w, c, ww) in zip(self._iowpages, self._cowpages, self._wwatchpages))
+
+    def snapshot(self):
+        # returns a MemorySnapshot of the current content, valid as long as
+        # it is referenced
+        snap = MemorySnapshot()
+        self._snapshots.add(snap)
+        self._cowpages[:] = Memory.ALL_IO
+        self._wpages[:] = Memory.ALL_IO
+        return snap
+
+    def restore(self, snap):
+        # restores the content at the time snap was taken, snap stays valid
+        for (page, data) in snap.pages.items():
+            self.copyOnWrite(page)
+            a = page << PAGE_SHIFT
+            self._mem[a:a+PAGE_SIZE] = data
+        snap.pages = {}
+        self._cowpages[:] = Memory.ALL_IO
+        self._wpages[:] = Memory.ALL_IO
+
+    def copyOnWrite(self, page):
+        # saves the page into the snapshots that don't have it yet
+        a = page << PAGE_SHIFT
+        data = None
+        for snap in self._snapshots:
+            if page not in snap.pages:
+                data = data or bytes(self._mem[a:a+PAGE_SIZE])
+                snap.pages[page] = data
+        self._cowpages[page] = 0
+        self._wpages[page] = self._iowpages[page] | self._wwatchpages[page]
+
+    def ram(self):
+        return self._mem
+
+    def ioPages(self):
+        return (self._rpages, self._wpages)
+
+    def devicePages(self):
+        return self._iowpages
+
+    def watching(self):
+        return len(self._watched) > 0
+
+    def isDevice(self, addr):
+        return (addr & 0xffff) in self._writers
+
+    def read8(self, addr):
+        addr &= 0xffff
+        if self._rpages[addr >> PAGE_SHIFT]:
+            read = self._readers.get(addr)
+            value = read(addr) if read is not None else self._mem[addr]
+            if self._watched.get(addr, 0) & Memory.WATCH_READ:
+                self.watchHits.append((addr, Memory.WATCH_READ, value))
+            return value
+        return self._mem[addr]
+
+    def read16(self, addr):
+        # little endian, the second byte wraps around to address 0
+        addr &= 0xffff
+        a1 = (addr + 1) & 0xffff
+        if self._rpages[addr >> PAGE_SHIFT] or self._rpages[a1 >> PAGE_SHIFT]:
+            return self.read8(addr) | (self.read8(a1) << 8)
+        return self._mem[addr] | (self._mem[a1] << 8)
+
+    def write8(self, addr, value):
+        addr &= 0xffff
+        value &= 0xff
+        if self._wpages[addr >> PAGE_SHIFT]:
+            if self._cowpages[addr >> PAGE_SHIFT]:
+                self.copyOnWrite(addr >> PAGE_SHIFT)
+            if self._watched.get(addr, 0) & Memory.WATCH_WRITE:
+                self.watchHits.append((addr, Memory.WATCH_WRITE, value))
+            write = self._writers.get(addr)
+            if write is not None:
+                write(addr, value)
+                return
+        self._mem[addr] = value
+
+    def write16(self, addr, value):
+        addr &= 0xffff
+        a1 = (addr + 1) & 0xffff
+        if self._wpages[addr >> PAGE_SHIFT] or self._wpages[a1 >> PAGE_SHIFT]:
+            self.write8(addr, value & 0xff)
+            self.write8(a1, (value >> 8) & 0xff)
+        else:
+            self._mem[addr] = value & 0xff
+            self._mem[a1] = (value >> 8) & 0xff
+
+
+class Uart:
+    # UART with status register (1: rx data available) and data register.
+    # Received bytes are queued in a FIFO, transmitted bytes are buffered
+    # until the host collects them with transmitted().
+    STATUS = 0xfffe
+    DATA = 0xffff
+
+    def __init__(self, rx_init=None):
+        self._rx_init = bytes(rx_init) if rx_init else b""
+        self.reset()
+
+    def reset(self):
+        self.rx_fifo = deque(self._rx_init)
+        self.tx_buffer = bytearray()
+
+    def receive(self, data):
+        # host -> CPU, data is a byte value or an iterable of byte values
+        if isinstance(data, int):
+            self.rx_fifo.append(data & 0xff)
+        else:
+            self.rx_fifo.extend(data)
+
+    def transmitted(self):
+        # CPU -> host, returns and clears the bytes sent since the last call
+        data = bytes(self.tx_buffer)
+        self.tx_buffer.clear()
+        return data
+
+    def readStatus(self, addr):
+        return 1 if self.rx_fifo else 0
+
+    def readData(self, addr):
+        return self.rx_fifo.popleft() if self.rx_fifo else 0
+
+    def writeData(self, addr, value):
+        self.tx_buffer.append(value)
+
+
+class Mif(Memory):
+    # Memory with the UART mapped to its registers. reset() restores memory
+    # and UART to the state after construction (or the last saveResetState()).
+    # Snapshots include the UART state.
+    def __init__(self, init=None, uart_rx_init=None):
+        super().__init__(init)
+        self.uart = Uart(uart_rx_init)
+        self.map(Uart.STATUS, read=self.uart.readStatus)
+        self.map(Uart.DATA, read=self.uart.readData, write=self.uart.writeData)
+        self.saveResetState()
+
+    def saveResetState(self):
+        self._resetsnap = self.snapshot()
+
+    def reset(self):
+        self.restore(self._resetsnap)
+
+    def snapshot(self):
+        snap = super().snapshot()
+        snap.uart = (bytes(self.uart.rx_fifo), bytes(self.uart.tx_buffer))
+        return snap
+
+    def restore(self, snap):
+        super().restore(snap)
+        self.uart.rx_fifo = deque(snap.uart[0])
+        self.uart.tx_buffer = bytearray(snap.uart[1])
@@ -1,29 +1,9 @@
 import sys
 
-from prim import Prim, MemoryIf
+from prim import Prim
 from primasm import PrimAsm
 from primconsts import *
-
-class Mif(MemoryIf):
-    def __init__(self, init=None):
-        self._mem = bytearray(0x10000)
-        if init is not None:
-            l = len(init)
-            self._mem[0:l] = init
-
-    def read8(self, addr):
-        return self._mem[addr]
-
-    def read16(self, addr):
-        return self._mem[addr] | (self._mem[addr+1] << 8)
-
-    def write8(self, addr, value):
-        self._mem[addr] = value & 0xff
-        self._mem[addr+1] = (value >> 8) & 0xff
-
-    def write16(self, addr, value):
-        self._mem[addr] = value & 0xff
-        self._mem[addr+1] = (value >> 8) & 0xff
+from primmem import Mif
 
 class Result:
     def __init__(self, T=None, N=None, R=None, carry=None, dsp=None, rsp=None, pc=None):
@@ -2,49 +2,23 @@
 
 import argparse
 from datetime import datetime
+import itertools
 import os
 import sys
-from prim import Prim, MemoryIf
+from prim import Prim
 from primasm import PrimAsm
+import primimage
+from primlits import LiteralIndex
+from primmem import Mif
 from primconsts import *
 from tokens import Token, BuildIn
-import toml
-import tomlfix
-
-class Mif(MemoryIf):
-    def __init__(self, init=None):
-        self._mem = bytearray(0x10000)
-        if init is not None:
-            self.init(init)
-
-    def init(self, mem):
-        l = len(mem)
-        self._mem[0:l] = mem
-
-    def read8(self, addr):
-        addr &= 0xffff
-        return self._mem[addr]
-
-    def read16(self, addr):
-        return self.read8(addr) | (self.read8(addr+1) << 8)
-
-    def write8(self, addr, value):
-        addr &= 0xffff
-        value &= 0xff
-        if addr == 0xffff:
-            print(f"uart-tx: {chr(value)} (0x{value:02x})")
-        else:
-            self._mem[addr] = int(value)
-
-    def write16(self, addr, value):
-        self.write8(addr, value & 0xff)
-        self.write8(addr+1, (value >> 8) & 0xff)
-
+import tokenizer
 
 class Dictionary:
     D = [] # definition names
     S = [] # string literal addresses
     N = [] # number literal addresses
+    L = LiteralIndex() # literal ranges of S and N
     def addNameDefinition(name):
         if name == "H":
             assert len(Dictionary.D) == 0, "Definition of 'H' must be first."
@@ -58,10 +32,12 @@ class Dictionary:
             Dictionary.addNameDefinition(sym)
     def lookupNameDefinition(idx):
         return Dictionary.D[idx]
-    def addStringLiteral(addr):
+    def addStringLiteral(addr, count):
         Dictionary.S.append(addr)
+        Dictionary.L.addString(addr, count)
     def addNumberLiteral(addr):
         Dictionary.N.append(addr)
+        Dictionary.L.addNumber(addr)
 
 
 def init(mif):
@@ -124,9 +100,10 @@ def execute(cpu, opcodes):
     assert l < 0xf0, f"too much immediate code"
     cpu._mif._mem[Consts.AREA:Consts.AREA+l] = opcodes
     cpu._pc = Consts.AREA
-    while cpu.step() != PrimOpcodes.BREAK:
-        #cpu.status()
+    while cpu.run(0x10000)[0] != Prim.STOP_BREAK:
         pass
+    for value in cpu._mif.uart.transmitted():
+        print(f"uart-tx: {chr(value)} (0x{value:02x})")
 
 
 def compile_string(mif, s):
@@ -134,7 +111,7 @@ def compile_string(mif, s):
     # so when this is executed, the string address is pushed on the stack and execution
     # continues "behind" the string data.
     here = HERE_FETCH(mif)
-    Dictionary.addStringLiteral(here + 7)
+    Dictionary.addStringLiteral(here + 7, len(s))
     strbytes = s.encode("utf-8")
     ops = []
     ops.extend(getPushOps(here + 7, shrink=False)) # 3 bytes
@@ -149,17 +126,24 @@ def execute_string(cpu, s):
     print("execute_string not implemented")
 
 
+def next16(tokens):
+    return next(tokens) | (next(tokens) << 8)
+
+
+def nextBytes(tokens, count):
+    return bytes(itertools.islice(tokens, count))
+
+
 def interpret(tokens, cpu):
-    idx = 0
+    # tokens is the token data as a list or as any iterable of bytes, e.g.
+    # the records of tokenizer.records() chained together
+    tokens = iter(tokens)
     mode = Token.MODE_COMPILE
-    while idx < len(tokens):
+    for tag in tokens:
         # print(f"here: {HERE(cpu._mif)}")
-        tag = tokens[idx]
         # print(f"tag: {Token.tagnames[tag]} ({tag})")
-        idx += 1
         if tag == Token.WORD_CALL:
-            di = tokens[idx] | (tokens[idx+1] << 8)
-            idx += 2
+            di = next16(tokens)
             #(name, addr) = Dictionary.lookupNameDefinition(di)
             addr = fetchFromIndex(cpu._mif, di)
             ops = getPushOps(addr)
@@ -170,8 +154,7 @@ def interpret(tokens, cpu):
             else:
                 execute(cpu, ops)
         elif tag == Token.WORD_ADDRESS:
-            di = tokens[idx] | (tokens[idx+1] << 8)
-            idx += 2
+            di = next16(tokens)
             addr = fetchFromIndex(cpu._mif, di)
             ops = getPushOps(addr)
             # print(f"word address: {Dictionary.D[di]}")
@@ -180,8 +163,7 @@ def interpret(tokens, cpu):
             else:
                 execute(cpu, ops)
         elif tag == Token.NUMBER:
-            num = tokens[idx] | (tokens[idx+1] << 8)
-            idx += 2
+            num = next16(tokens)
             ops = getPushOps(num)
             # print(f"number: {num}")
             if mode == Token.MODE_COMPILE:
@@ -189,72 +171,66 @@ def interpret(tokens, cpu):
             else:
                 execute(cpu, ops)
         elif tag == Token.STRING:
-            l = tokens[idx]
-            s = bytearray(tokens[idx+1:idx+1+l]).decode("utf-8")
-            idx += l + 1
+            l = next(tokens)
+            s = nextBytes(tokens, l).decode("utf-8")
             # print(f"string: {s}")
             if mode == Token.MODE_COMPILE:
                 compile_string(cpu._mif, s)
             else:
                 execute_string(cpu, s)
         elif tag == Token.MNEMONIC:
-            # print(f"mnemonic {PrimAsm.disassembleOpcode(tokens[idx])}")
+            opcode = next(tokens)
+            # print(f"mnemonic {PrimAsm.disassembleOpcode(opcode)}")
             if mode == Token.MODE_COMPILE:
-                comma(cpu._mif, [tokens[idx]])
+                comma(cpu._mif, [opcode])
             else:
-                execute(cpu, [tokens[idx]])
-            idx += 1
+                execute(cpu, [opcode])
         elif tag == Token.BUILDIN:
-            asm = BuildIn.lookupByIndex(tokens[idx])[1]
+            asm = BuildIn.lookupByIndex(next(tokens))[1]
             ops = PrimAsm.assemble(asm)
-            # print(f"buildin {tokens[idx]}: '{asm}' {ops}")
-            idx += 1
+            # print(f"buildin: '{asm}' {ops}")
             if mode == Token.MODE_COMPILE:
                 comma(cpu._mif, ops)
             else:
                 execute(cpu, ops)
         elif tag == Token.LIT_NUMBER:
-            # print(f"Literal number: {tokens[idx] | (tokens[idx+1] << 8)}")
+            num = next16(tokens)
+            # print(f"Literal number: {num}")
             Dictionary.addNumberLiteral(HERE_FETCH(cpu._mif))
-            comma(cpu._mif, tokens[idx:idx+2])
-            idx += 2
+            comma16(cpu._mif, num)
         elif tag == Token.LIT_STRING:
-            l = tokens[idx]
-            name = bytearray(tokens[idx+1:idx+1+l]).decode("utf-8")
-            idx += l + 1
-            # print(f"Literal string: {name}")
+            l = next(tokens)
+            s = nextBytes(tokens, l)
+            # print(f"Literal string: {s}")
+            Dictionary.addStringLiteral(HERE_FETCH(cpu._mif), l)
             comma(cpu._mif, [l])
-            comma(cpu._mif, tokens[idx:idx+1])
+            comma(cpu._mif, s)
         elif tag == Token.LIT_ADDRESS:
-            # print(f"Literal address: {tokens[idx] | (tokens[idx+1] << 8)}")
+            di = next16(tokens)
+            # print(f"Literal address: {di}")
             Dictionary.addNumberLiteral(HERE_FETCH(cpu._mif))
-            di = tokens[idx] | (tokens[idx+1] << 8)
-            idx += 2
             addr = fetchFromIndex(cpu._mif, di)
             comma16(cpu._mif, addr)
         elif tag == Token.DEFINITION:
-            l = tokens[idx]
-            name_ba = bytearray(tokens[idx+1:idx+1+l])
-            name = name_ba.decode("utf-8")
-            idx += l + 1
+            l = next(tokens)
+            name = nextBytes(tokens, l).decode("utf-8")
             print(f"Definition: {name} @ 0x{HERE_FETCH(cpu._mif):x}")
             # Dictionary.addNameDefinition(name)
             appendToIndex(cpu._mif, HERE_FETCH(cpu._mif))
         elif tag == Token.MODE:
-            mode = tokens[idx]
-            idx += 1
+            mode = next(tokens)
             # if mode == Token.MODE_COMPILE:
             #     print("compile mode")
             # else:
             #     print("immediate mode")
         elif tag in [Token.COMMENT_BACKSLASH, Token.COMMENT_BRACES, Token.WHITESPACE]:
-            l = tokens[idx]
-            idx += l + 1
+            l = next(tokens)
+            nextBytes(tokens, l)
         else:
             assert False, "Tag not handled!"
 
 
-def saveData(infn, outfn, mif):
+def saveData(infn, outfn, mif, date=True):
     # symbolMap = {}
     # for idx,sym in enumerate(Dictionary.D):
     #     symbolMap[sym] = fetchFromIndex(mif, idx)
@@ -269,44 +245,88 @@ def saveData(infn, outfn, mif):
         "num-literals": Dictionary.N,
         "memory": mif._mem
     }
-    with open(outfn, mode="wt") as f:
-        f.write(toml.dumps(tomldata))
-
-def main():
-    parser = argparse.ArgumentParser(description='Prim ColorForth Tokenizer')
-    parser.add_argument("-i", help="Input TOML filename", action="store", metavar="<input file>", type=str, required=False, dest="input_filename",default="")
-    parser.add_argument("-o", help="Output TOML filename", metavar="<output filename>", action="store", type=str, required=False, dest="output_filename",default="")
-    args = parser.parse_args()
+    if not date: # image depends on its inputs only
+        del tomldata["date"]
+    primimage.save(outfn, tomldata)
 
-    inTomlData = toml.load(args.input_filename)
-    tokendata = inTomlData["tokens"]
-    memory = inTomlData["memory"]
-    symbols = tomlfix.workaround(inTomlData["symbols"])
-    strlits = inTomlData["string-literals"]
-    numlits = inTomlData["num-literals"]
+def setup(inTomlData):
+    # CPU with the memory, symbols and literals of the input image
+    memory = inTomlData.get("memory", [])
+    symbols = inTomlData["symbols"]
+    strlits = inTomlData.get("string-literals", [])
+    numlits = inTomlData.get("num-literals", [])
 
     for sym in symbols:
         Dictionary.addNameDefinition(sym)
 
-    for lit in strlits:
-        Dictionary.S.append(lit)
-
-    for lit in numlits:
-        Dictionary.N.append(lit)
-
     mif = Mif()
     if len(memory) > 0:
         mif.init(memory)
     else:
         init(mif)
 
-    cpu = Prim(mif)
+    for lit in strlits:
+        Dictionary.addStringLiteral(lit, mif.read8(lit))
+
+    for lit in numlits:
+        Dictionary.addNumberLiteral(lit)
+
+    return Prim(mif)
+
+
+def collect(records, data):
+    # passes the token records on, keeping their data
+    for record in records:
+        data.extend(record)
+        yield record
+
+
+def compileSource(sourcefn, inputfn, outfn, tokensfn="", date=True):
+    # tokenizes and compiles the source in one go, each token is compiled
+    # as soon as the tokenizer yields it. The tokenizer image is only
+    # written if tokensfn is given.
+    inTomlData = tokenizer.loadInput(inputfn)
+    cpu = setup(inTomlData)
+    records = tokenizer.records(sourcefn, inTomlData["symbols"])
+    tokendata = []
+    if tokensfn:
+        records = collect(records, tokendata)
+
+    interpret(itertools.chain.from_iterable(records), cpu)
+
+    # the definitions of the source follow the input image's symbols
+    for (name, idx) in Token.D.items():
+        if idx >= len(inTomlData["symbols"]):
+            Dictionary.addNameDefinition(name)
+
+    cpu.status()
+
+    if tokensfn:
+        primimage.save(tokensfn, tokenizer.imageData(sourcefn, inputfn, inTomlData, tokendata, date))
+    saveData(sourcefn, outfn, cpu._mif, date)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Prim ColorForth Tokenizer')
+    parser.add_argument("-i", help="Input image filename (binary or TOML), with -s the image the source is compiled against", action="store", metavar="<input file>", type=str, required=False, dest="input_filename",default="")
+    parser.add_argument("-o", help="Output image filename (TOML if it ends with .toml)", metavar="<output filename>", action="store", type=str, required=False, dest="output_filename",default="")
+    parser.add_argument("-s", help="TokenForth source, tokenized and compiled without a tokenizer image", metavar="<source file>", action="store", type=str, required=False, dest="source_filename",default="")
+    parser.add_argument("-t", help="With -s: also write the tokenizer image", metavar="<tokens filename>", action="store", type=str, required=False, dest="tokens_filename",default="")
+    parser.add_argument("-nd", help="Do not write the date into the image", action="store_false", required=False, dest="date")
+    args = parser.parse_args()
+
+    if args.source_filename:
+        compileSource(args.source_filename, args.input_filename, args.output_filename, args.tokens_filename, args.date)
+        return
+
+    inTomlData = primimage.load(args.input_filename)
+    cpu = setup(inTomlData)
 
-    interpret(tokendata, cpu)
+    interpret(inTomlData["tokens"], cpu)
 
     cpu.status()
 
-    saveData(args.input_filename, args.output_filename, cpu._mif)
+    saveData(args.input_filename, args.output_filename, cpu._mif, args.date)
 
 
 if __name__ == "__main__":
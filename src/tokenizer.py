@@ -2,108 +2,90 @@
 
 import argparse
 from datetime import datetime
+import gc
+import hashlib
+import itertools
+import json
 import sys
 from tokens import *
 import primasm
-import toml
-import tomlfix
+import primimage
+import re
 
 class Fragment:
-    def __init__(self, _s, _linenum):
+    def __init__(self, _s, _linenum, _col=1):
         self.s = _s
         self.linenum = _linenum
+        self.col = _col
 
 
-def fragment(s):
-    # create list of words and whitespaces
-    fragments = []
-    t = ""
-    space = False
-    for c in s:
-        o = ord(c)
-        if space:
-            if ord(c) < 33:
-                t += c
-            else:
-                fragments.append(t)
-                t = c
-                space = False
-        else:
-            if ord(c) < 33:
-                fragments.append(t)
-                space = True
-                t = c
-            else:
-                t += c
-    fragments.append(t)
-    return fragments
-
-
-def merge_comment_fragments(fragments):
-    ## merge comments to single fragment
-    merge = []
-    # \ comments
-    try:
-        f = fragments.index("\\")
-        merge = fragments[0:f] # fragments before "\""
-        if fragments[-1] == '\n':
-            merge.append("".join(fragments[f:-1])) # join fragments up to (but excluding) newline
-            merge.append(fragments[-1]) # append newline as separate fragment
-        else:
-            merge.append("".join(fragments[f:])) # join rest of line (there is no newline)
-        fragments = merge
-    except:
-        pass
-    # () comments
-    try:
-        c1 = fragments.index("(")
-        c2 = fragments.index(")")
-        merge = fragments[0:c1]
-        comment = "".join(fragments[c1:c2+1])
-        merge.append(comment)
-        merge.extend(fragments[c2+1:])
-        fragments = merge
-    except:
-        pass
-    return fragments
-
-def merge_string_fragments(fragments):
-    ## merge strings like "Hello World" to single fragment
-    merge = []
-    nfl = [] # new fragment list
-    stringfragment = False
-    for i in range(len(fragments)):
-        f = fragments[i]
-        if (not stringfragment):
-            if (len(f) > 0) and (f[0] == '"') and (f[-1] != '"'):
-                # start of string literal
-                stringfragment = True
-                merge = []
-                merge.append(f)
-            else:
-                nfl.append(f)
-        else:
-            if (len(f) > 0) and (f[-1] == '"'):
-                # end of string literal
-                merge.append(f)
-                nfl.append("".join(merge))
-                stringfragment = False
-            else:
-                merge.append(f)
-    assert stringfragment == False, f"ERROR: String literal {merge} missing double quote"
-    return nfl
+# Every character below 33 is whitespace. A whitespace fragment ends with a
+# newline, so each line starts with a new fragment. "\\" comments run to
+# the end of the line (the newline is a fragment of its own if nothing but
+# the newline follows the comment text), "( ... )" comments and strings
+# may span lines.
+WS = r"[\x00-\x20]"
+LEXER = re.compile(r"""
+    (?P<ws> [\x00-\x09\x0b-\x20]*\n | [\x00-\x09\x0b-\x20]+ )
+  | (?P<backslash> \\ (?= WS | \Z) (?: (?: [^\n]* [^\x00-\x20] )? (?=\n) | [^\n]* \n? ) )
+  | (?P<braces> \( (?= WS ) [\s\S]*? WS \) (?= WS | \Z) )
+  | (?P<string> " (?! WS | \Z ) [\s\S]*? " (?= WS | \Z) )
+  | (?P<unterminated> " [^\x00-\x20]*? [^\x00-\x20"] (?= WS | \Z) )
+  | (?P<word> [^\x00-\x20]+ )
+""".replace("WS", WS), re.VERBOSE)
+
+
+def lex(text, pos=0, line=1):
+    # yields the fragments (words, whitespace, comments and strings) of the
+    # source text with line and column in a single pass, pos must be the
+    # start of a line
+    linestart = pos
+    for m in LEXER.finditer(text, pos):
+        s = m.group()
+        start = m.start()
+        assert m.lastgroup != "unterminated", f"ERROR on line {line}: String literal {s} missing double quote"
+        yield Fragment(s, line, start - linestart + 1)
+        if "\n" in s:
+            line += s.count("\n")
+            linestart = start + s.rindex("\n") + 1
+
+
+# Fixed spellings: "[", "]", mnemonics in any case with and without
+# ".RET", buildins. CLASSES maps each spelling to (token class, payload),
+# the payload is the mode, opcode byte or buildin index.
+CLASSES = {}
+
+def caseSpellings(s):
+    return set("".join(p) for p in itertools.product(*(set((c.lower(), c.upper())) for c in s)))
+
+
+def addClass(spelling, cls, payload):
+    # first one wins, like the order of the checks in tokenizeFragments
+    CLASSES.setdefault(spelling, (cls, payload))
+
+
+def addBuildin(name, asm):
+    BuildIn.add(name, asm)
+    addClass(name, TokenBuildin, BuildIn.getIndexByName(name))
+
+
+addClass("[", TokenMode, Token.MODE_IMMEDIATE)
+addClass("]", TokenMode, Token.MODE_COMPILE)
+for (name, opcode) in primasm.PrimAsm.INSTRUCTIONS.items():
+    for s in caseSpellings(name):
+        addClass(s, TokenMnemonic, opcode)
+    for s in caseSpellings(name + ".RET"):
+        addClass(s, TokenMnemonic, opcode | 0x80)
+for (name, asm) in BuildIn.BUILDINS:
+    addClass(name, TokenBuildin, BuildIn.getIndexByName(name))
 
 
 def isMnemonic(s):
-    s = s.upper()
-    if s[-4:] == ".RET":
-        s = s[0:-4]
-    return s.upper() in primasm.PrimAsm.INSTRUCTIONS
+    return CLASSES.get(s, (None,))[0] is TokenMnemonic
 
 
 def isBuildin(s):
-    idx = BuildIn.getIndexByName(s)
-    return idx >= 0
+    return CLASSES.get(s, (None,))[0] is TokenBuildin
 
 
 def stringToNumber(s):
@@ -115,28 +97,25 @@ def stringToNumber(s):
     return int(s, 10)
 
 
-def tokenizeFragments(fragments):
-    tokens = []
-    immediate = False
+def tokenizeFragments(fragments, immediate=False):
+    return list(tokenizeStream(fragments, immediate))
+
+
+def tokenizeStream(fragments, immediate=False):
+    # yields the token of each fragment as soon as it is classified
     for f in fragments:
         t = f.s
         newTokens = None
-        if len(t.strip()):
+        cls = CLASSES.get(t)
+        if cls is not None: # "[", "]", mnemonic, buildin like ";"
+            newTokens = cls[0](t, f, cls[1])
+            if cls[0] is TokenMode:
+                immediate = cls[1] == Token.MODE_IMMEDIATE
+        elif len(t.strip()):
             # print(f"'{t.strip()}'")
-            if t == "[":
-                newTokens = TokenMode(t, f, Token.MODE_IMMEDIATE)
-                immediate = True
-            elif t == "]":
-                newTokens = TokenMode(t, f, Token.MODE_COMPILE)
-                immediate = False
-            elif t[0] == ":": # add name to (virtual) dictionary ":name"
+            if t[0] == ":": # add name to (virtual) dictionary ":name"
                 assert not immediate, f"ERROR on line {f.linenum}: Definition {t[1:]} not possible in immediate mode."
                 newTokens = TokenDefinition(t[1:], f)
-            elif isMnemonic(t):
-                newTokens = TokenMnemonic(t, f)
-                pass
-            elif isBuildin(t): # ";"
-                newTokens = TokenBuildin(t, f)
             elif t[0] == "#":
                 assert not immediate, f"ERROR on line {f.linenum}: Literal {t} not possible in immediate mode."
                 if (len(t) > 3) and (t[1] == '"') and t[-1] == '"':
@@ -157,7 +136,7 @@ def tokenizeFragments(fragments):
                 newTokens = TokenString(t[1:-1], f)
             elif t[0:2] == "\ ": # "\ comment"
                 newTokens = TokenCommentBackslash(t, f)
-            elif t[0:2] == "( ": # "( comment )"
+            elif t[0] == "(" and len(t) > 1 and ord(t[1]) < 33: # "( comment )"
                 newTokens = TokenCommentBraces(t, f)
             elif t[0] == "'": # "'name"
                 newTokens = TokenWordAddress(t[1:], f)
@@ -177,29 +156,154 @@ def tokenizeFragments(fragments):
                 if ord(t[0]) < 33:
                     newTokens = TokenWhitespace(t, f)
         if newTokens is not None:
-            tokens.append(newTokens)
-    return tokens
+            yield newTokens
+
+# Incremental tokenizing: the source is split into regions that start at
+# the beginning of a line and end with the first fragment that ends with a
+# newline (a string or "( ... )" comment makes a region span lines). The
+# cache file maps the hash of a region's first line and the mode at its
+# start to
+#   [length, hash of the region, immediate mode at the end, token bytes (hex),
+#    word references [offset, name], definitions and name lookups in order]
+# A cached region is used if its text is unchanged and each lookup gives the
+# same result again, the definitions are replayed. The word references are
+# filled in at the end, like generate() does. The output is the same as
+# tokenizing the whole file.
+CACHE_VERSION = 1
+REFERENCES = (TokenWordCall, TokenWordAddress, TokenLiteralAddress)
+
+def regionHash(s):
+    return hashlib.blake2b(s.encode(), digest_size=12).hexdigest()
+
+
+def cacheVersion():
+    # the cache is invalid if the fixed spellings change (e.g. a new buildin)
+    table = sorted((s, cls[0].__name__, cls[1]) for (s, cls) in CLASSES.items())
+    return f"{CACHE_VERSION} {regionHash(repr(table))}"
+
+
+def loadCache(fn):
+    try:
+        with open(fn, "rt") as f:
+            cache = json.load(f)
+        if cache["version"] == cacheVersion():
+            return cache["regions"]
+    except:
+        pass
+    return {}
+
+
+def saveCache(fn, regions):
+    with open(fn, "wt") as f:
+        f.write(json.dumps({ "version": cacheVersion(), "regions": regions }, separators=(",", ":")))
 
-def convert(sourcefn, symbols):
+
+def tokenizeRegion(text, pos, line, immediate):
+    fragments = []
+    for f in lex(text, pos, line):
+        fragments.append(f)
+        if f.s[-1] == "\n":
+            break
+    Token.trace = []
+    try:
+        tokens = tokenizeFragments(fragments, immediate)
+        events = Token.trace
+    finally:
+        Token.trace = None
+    data = bytearray()
+    refs = []
+    for t in tokens:
+        if isinstance(t, TokenMode):
+            immediate = t.mode == Token.MODE_IMMEDIATE
+        if isinstance(t, REFERENCES):
+            refs.append([len(data) + 1, t.name])
+            data.extend([t.tag, 0, 0])
+        else:
+            data.extend(t.generate())
+    length = sum(len(f.s) for f in fragments)
+    return [length, regionHash(text[pos:pos+length]), immediate, data.hex(), refs, events]
+
+
+def replay(events):
+    # adds the definitions of a cached region, returns False (and leaves
+    # the definitions unchanged) if a lookup has a different result now
+    added = []
+    for e in events:
+        if e[0] == "def":
+            Token.addDefinition(e[1])
+            added.append(e[1])
+        elif (e[1] in Token.D) != e[2]:
+            for name in added:
+                del Token.D[name]
+            Token.Didx -= len(added)
+            return False
+    return True
+
+
+def tokenizeCached(text, cache):
+    # returns token bytes, the cache entries of all regions of text and
+    # the number of regions that were tokenized
+    data = bytearray()
+    refs = []
+    used = {}
+    misses = 0
+    immediate = False
+    pos = 0
+    line = 1
+    while pos < len(text):
+        eol = text.find("\n", pos) + 1 or len(text)
+        key = regionHash(text[pos:eol]) + ("i" if immediate else "c")
+        entry = cache.get(key)
+        if entry is not None and entry[0] != eol - pos:
+            # region spans lines, they must be unchanged and the region
+            # must end with a newline or at the end of the text as before
+            end = pos + entry[0]
+            if regionHash(text[pos:end]) != entry[1] or (text[end-1] != "\n" and end != len(text)):
+                entry = None
+        if entry is None or not replay(entry[5]):
+            entry = tokenizeRegion(text, pos, line, immediate)
+            misses += 1
+        used[key] = entry
+        (length, _, immediate, tokendata, regionrefs, _) = entry
+        if regionrefs:
+            refs.append((len(data), regionrefs))
+        data.extend(bytes.fromhex(tokendata))
+        line += text.count("\n", pos, pos + length)
+        pos += length
+    D = Token.D
+    for (base, regionrefs) in refs:
+        for (offset, name) in regionrefs:
+            addr = D[name]
+            data[base+offset] = addr & 0xff
+            data[base+offset+1] = (addr >> 8) & 0xff
+    return (data, used, misses)
+
+
+def convert(sourcefn, symbols, cachefn=None):
     for sym in symbols:
         Token.addDefinition(sym)
 
     # load colorforth source file
     try:
         with open(sourcefn,"r") as f:
-            lines = f.readlines()
+            text = f.read()
     except:
         print(f"ERROR: Cannot open file {sourcefn}")
         return None
 
-    fragments = []
-    for num,line in enumerate(lines):
-        frags = merge_comment_fragments(fragment(line))
-        frags = merge_string_fragments(frags)
-        for f in frags:
-            fragments.append(Fragment(f, num+1))
-
-    tokens = tokenizeFragments(fragments)
+    # all fragments and tokens are kept until the end, garbage collection
+    # while creating them only costs time
+    gc.disable()
+    try:
+        if cachefn:
+            cache = loadCache(cachefn)
+            (data, regions, misses) = tokenizeCached(text, cache)
+            if misses or len(regions) != len(cache):
+                saveCache(cachefn, regions)
+            return list(data)
+        tokens = tokenizeFragments(lex(text))
+    finally:
+        gc.enable()
 
     # print("\nTokens:")
     data = []
@@ -214,27 +318,32 @@ def convert(sourcefn, symbols):
     return data
 
 
-def main():
-    parser = argparse.ArgumentParser(description='Prim ColorForth Tokenizer')
-    parser.add_argument("-i", help="Assembly input filename", action="store", metavar="<input filename>", type=str, required=True, dest="input_filename",default="")
-    parser.add_argument("-it", help="Input TOML filename", action="store", metavar="<input filename>", type=str, required=False, dest="input_toml_filename",default="")
-    parser.add_argument("-o", help="Output TOML filename", metavar="<output filename>", action="store", type=str, required=True, dest="output_toml_filename",default="")
-    args = parser.parse_args()
+def records(sourcefn, symbols):
+    # yields the token data of each token while the source is tokenized,
+    # e.g. for tokenforth.interpret(). Unlike convert(), a word address
+    # ('name) must be defined before it is used.
+    for sym in symbols:
+        Token.addDefinition(sym)
+    with open(sourcefn, "r") as f:
+        text = f.read()
+    for t in tokenizeStream(lex(text)):
+        yield t.generate()
 
-    try:
-        inTomlData = toml.load(args.input_toml_filename)
-        symbols = tomlfix.workaround(inTomlData["symbols"])
-        tomlTypeIsCorrent = ("type" in inTomlData) and (inTomlData["type"] == "tokenforth")
-    except:
-        symbols = ["H", "LATEST"]
-        tomlTypeIsCorrent = True
+
+def loadInput(fn):
+    # the tokenforth image a source is tokenized against, without one only
+    # H and LATEST are defined. A file that cannot be loaded is an error.
+    if not fn:
+        return { "symbols": ["H", "LATEST"] }
+    inTomlData = primimage.load(fn)
+    tomlTypeIsCorrent = ("type" in inTomlData) and (inTomlData["type"] == "tokenforth") and ("symbols" in inTomlData)
 
     if not tomlTypeIsCorrent:
         raise Exception("Wrong TOML type (cannot use tokenizer TOML files)")
+    return inTomlData
 
-    # create token data
-    tokendata = convert(args.input_filename, symbols)
 
+def imageData(sourcefn, inputfn, inTomlData, tokendata, date=True):
     # make list from symbol dictionary
     symbols = [""] * len(Token.D)
     for key,value in Token.D.items():
@@ -256,19 +365,36 @@ def main():
         numlits = []
 
     # compile data to write toml file
-    tomldata = { "title": f"Tokenized {args.input_filename}",
+    tomldata = { "title": f"Tokenized {sourcefn}",
                  "date": f"{datetime.now().strftime('%d.%m.%Y %H:%M:%S')}",
-                 "input-toml": f"{args.input_toml_filename}",
+                 "input-toml": f"{inputfn}",
                  "type": "tokenizer",
                  "symbols": symbols,
                  "string-literals": strlits,
                  "num-literals": numlits,
                  "tokens": tokendata,
                  "memory": memory }
+    if not date: # image depends on its inputs only
+        del tomldata["date"]
+    return tomldata
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Prim ColorForth Tokenizer')
+    parser.add_argument("-i", help="Assembly input filename", action="store", metavar="<input filename>", type=str, required=True, dest="input_filename",default="")
+    parser.add_argument("-it", help="Input image filename (binary or TOML)", action="store", metavar="<input filename>", type=str, required=False, dest="input_toml_filename",default="")
+    parser.add_argument("-o", help="Output image filename (TOML if it ends with .toml)", metavar="<output filename>", action="store", type=str, required=True, dest="output_toml_filename",default="")
+    parser.add_argument("-c", help="Cache file, only changed lines are tokenized again", metavar="<cache filename>", action="store", type=str, required=False, dest="cache_filename",default="")
+    parser.add_argument("-nd", help="Do not write the date into the image", action="store_false", required=False, dest="date")
+    args = parser.parse_args()
+
+    inTomlData = loadInput(args.input_toml_filename)
+
+    # create token data
+    tokendata = convert(args.input_filename, inTomlData["symbols"], args.cache_filename)
 
     # write to file
-    with open(args.output_toml_filename, mode="wt") as f:
-        f.write(toml.dumps(tomldata))
+    primimage.save(args.output_toml_filename, imageData(args.input_filename, args.input_toml_filename, inTomlData, tokendata, args.date))
 
 if __name__ == "__main__":
     sys.exit(main())
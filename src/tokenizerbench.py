@@ -0,0 +1,73 @@
+#! /usr/bin/env python3
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+import tokenizer
+from tokens import Token
+
+def generateSource(lines, words, seed=0):
+    # TokenForth source with one definition per line, calling earlier
+    # definitions and with strings and (at most one per line) comments in
+    # between
+    rnd = random.Random(seed)
+    vocabulary = ["dup", "drop", "swap", "over", "+", "-", "@", "!", "c@", "c!", "1", "$ff", "0x10", "#5"]
+    out = []
+    for i in range(lines):
+        parts = [f":w{i}"]
+        for k in range(words):
+            r = rnd.random()
+            if r < 0.05:
+                parts.append('"a string"')
+            elif r < 0.1 and "( a comment )" not in parts:
+                parts.append("( a comment )")
+            else:
+                parts.append(rnd.choice(vocabulary))
+        parts.append(";")
+        if i % 10 == 0:
+            parts.append("\\ comment")
+        out.append(" ".join(parts))
+        vocabulary.append(f"w{i}")
+        if len(vocabulary) > 100:
+            del vocabulary[14]
+    return "\n".join(out) + "\n"
+
+
+def main():
+    parser = argparse.ArgumentParser(description='TokenForth tokenizer benchmark')
+    parser.add_argument("-n", help="Number of lines", action="store", metavar="<lines>", type=int, required=False, dest="lines", default=100000)
+    parser.add_argument("-w", help="Words per line", action="store", metavar="<words>", type=int, required=False, dest="words", default=10)
+    parser.add_argument("-c", help="Also time a cached run after changing one line", action="store_true", required=False, dest="cached", default=False)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as d:
+        fn = os.path.join(d, "bench.cf")
+        cachefn = os.path.join(d, "bench.cache") if args.cached else None
+        source = generateSource(args.lines, args.words)
+        with open(fn, "wt") as f:
+            f.write(source)
+        t = time.perf_counter()
+        data = tokenizer.convert(fn, ["H", "LATEST"], cachefn)
+        t = time.perf_counter() - t
+        print(f"{args.lines} lines, {args.words} words per line: {len(data)} token bytes in {t:.3f} s, {args.lines / t:,.0f} lines/s")
+        if args.cached:
+            # change a word in the middle of the file, tokenize again
+            lines = source.split("\n")
+            i = args.lines // 2
+            lines[i] = lines[i].replace(" ", " dup ", 1)
+            with open(fn, "wt") as f:
+                f.write("\n".join(lines))
+            Token.D = {}
+            Token.Didx = 0
+            t = time.perf_counter()
+            data = tokenizer.convert(fn, ["H", "LATEST"], cachefn)
+            t = time.perf_counter() - t
+            print(f"cached, one line changed: {len(data)} token bytes in {t:.3f} s, {args.lines / t:,.0f} lines/s")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
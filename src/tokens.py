@@ -8,13 +8,17 @@ def lohi(v):
 
 class BuildIn:
     BUILDINS = [(";", "NOP.RET")]
+    INDEX = {} # name: index in BUILDINS
+    def add(name, asm):
+        BuildIn.BUILDINS.append((name, asm))
+        BuildIn.INDEX.setdefault(name, len(BuildIn.BUILDINS) - 1)
     def lookupByIndex(idx):
         return BuildIn.BUILDINS[idx]
     def getIndexByName(name):
-        for i,b in enumerate(BuildIn.BUILDINS):
-            if b[0] == name:
-                return i
-        return -1
+        return BuildIn.INDEX.get(name, -1)
+
+for i,b in enumerate(BuildIn.BUILDINS):
+    BuildIn.INDEX.setdefault(b[0], i)
 
 
 class Token:
@@ -42,6 +46,7 @@ class Token:
     D = {} # TODO: repleace with list
     Didx = 0
     mode = MODE_COMPILE
+    trace = None # ["def", name] and ["has", name, found] are appended if a list
 
     tagnames = ["WORD_CALL", "WORD_ADDRESS", "NUMBER", "STRING", "MNEMONIC", "BUILDIN", "LIT_NUMBER", "LIT_STRING", "LIT_ADDRESS", "DEFINITION", "MODE", "COMMENT_BRACES", "COMMENT_BACKSLASH", "WHITESPACE"]
 
@@ -54,9 +59,14 @@ class Token:
         # print(f"Definition {Token.Didx}: {name}")
         Token.D[name] = Token.Didx
         Token.Didx += 1
+        if Token.trace is not None:
+            Token.trace.append(["def", name])
 
     def definitionAvailable(name):
-        return name in Token.D
+        found = name in Token.D
+        if Token.trace is not None:
+            Token.trace.append(["has", name, found])
+        return found
 
     def generate(self):
         ...
@@ -150,14 +160,17 @@ class TokenString(Token):
 
 
 class TokenMnemonic(Token):
-    def __init__(self, s, fragment):
+    def __init__(self, s, fragment, opcode=None):
         super().__init__(self.MNEMONIC, fragment)
         self.mnemonic = s
+        self.opcode = opcode # assembled from mnemonic if None
         # if Token.mode == Token.MODE_IMMEDIATE:
         #     sys.stdout.write("Immediate ")
         # print(f"Mnemonic {s}")
 
     def generate(self):
+        if self.opcode is not None:
+            return [self.tag, self.opcode]
         data = [self.tag]
         data.extend(PrimAsm.assemble(self.mnemonic))
         assert len(data) == 2
@@ -165,15 +178,16 @@ class TokenMnemonic(Token):
 
 
 class TokenBuildin(Token):
-    def __init__(self, s, fragment):
+    def __init__(self, s, fragment, index=None):
         super().__init__(self.BUILDIN, fragment)
         self.name = s
+        self.index = index # looked up by name if None
         # if Token.mode == Token.MODE_IMMEDIATE:
         #     sys.stdout.write("Immediate ")
         # print(f"Buildin {s}")
 
     def generate(self):
-        buildin = BuildIn.getIndexByName(self.name)
+        buildin = self.index if self.index is not None else BuildIn.getIndexByName(self.name)
         assert buildin >= 0, f"Buildin {self.name} not found"
         data = [self.tag, buildin]
         return data